@@ -1,26 +1,147 @@
+from time import perf_counter
 
-from flask import Flask, render_template_string, jsonify
-from flask_sqlalchemy import SQLAlchemy
+# Startup profiling: the wall time of every phase until the alarm path is live
+# (imports included) is printed once by startup_report() and kept for /metrics.
+# For a per-module import breakdown, run `python -X importtime app.py`.
+startup = {'started': perf_counter(), 'clock': perf_counter(), 'phases': [], 'background': {}, 'ready_after': None}
+
+def startup_phase(name):
+    """Close the running startup phase under `name`; the next one starts now."""
+    now = perf_counter()
+    startup['phases'].append((name, now - startup['clock']))
+    startup['clock'] = now
+
+from flask import Flask, render_template, stream_template, jsonify, request, abort, Response
+startup_phase('import flask')
 from flask_mqtt import Mqtt
-from datetime import datetime
+from paho.mqtt import publish
+startup_phase('import flask_mqtt')
+from datetime import datetime, timedelta, timezone
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from array import array
+import atexit
+import bisect
+import fcntl
+import gc
+import gzip
+import hmac
+import itertools
+import json
+import math
+import os
+import queue
+import re
+import shutil
+import signal
+import socket
+import sys
 import threading
 import http.client, urllib
-from time import time
-
-last_pushover_time = {'timestamp': 0}
+import sqlite3
+import struct
+import tracemalloc
+import zlib
+from time import time, sleep, monotonic
+startup_phase('import stdlib')
 
 PUSHOVER_COOLDOWN = 60  # seconds
 
-alarm_state = {'enabled': True}
+# Served from memory on every reading and poll; written through AlarmSetting
+alarm_state = {'enabled': True, 'version': 0}
+alarm_state_lock = threading.Lock()  # writers only
+
+# INSTANCE_PATH lets a second copy run from the same checkout with its own database
+instance_path = os.environ.get('INSTANCE_PATH')
+app = Flask(__name__, instance_path=os.path.abspath(instance_path) if instance_path else None)
+
+# Debug endpoints (/debug/...) are disabled unless a token is configured
+app.config['DEBUG_TOKEN'] = os.environ.get('DEBUG_TOKEN', '')
 
-app = Flask(__name__)
+# Multi-site forwarding: a site ships its readings and alarm events to FORWARD_URL
+# (another instance's /ingest/batch); an instance with AGGREGATOR_TOKEN accepts them.
+app.config['SITE_ID'] = os.environ.get('SITE_ID', socket.gethostname())
+app.config['FORWARD_URL'] = os.environ.get('FORWARD_URL', '')
+app.config['FORWARD_TOKEN'] = os.environ.get('FORWARD_TOKEN', '')
+app.config['AGGREGATOR_TOKEN'] = os.environ.get('AGGREGATOR_TOKEN', '')
+
+# Notification channels every notification fans out to (see NOTIFIERS)
+app.config['NOTIFY_CHANNELS'] = os.environ.get('NOTIFY_CHANNELS', 'pushover')
+
+# Pushover Configuration (PUSHOVER_URL can point at a local stand-in for testing)
+app.config['PUSHOVER_URL'] = os.environ.get('PUSHOVER_URL', 'https://api.pushover.net/1/messages.json')
+app.config['PUSHOVER_TOKEN'] = os.environ.get('PUSHOVER_TOKEN', 'aht73m2ii3vyotoz58swdkhrdmya4f')
+app.config['PUSHOVER_USER'] = os.environ.get('PUSHOVER_USER', 'upcm7jkikk2p2i16i7dfxicnwqodp9')
+
+# Other channels: a JSON webhook, an MQTT topic for a siren (alarm triggers
+# only) and a local log file (default instance/notifications.log)
+app.config['WEBHOOK_URL'] = os.environ.get('WEBHOOK_URL', '')
+app.config['SIREN_TOPIC'] = os.environ.get('SIREN_TOPIC', 'alarm/siren')
+app.config['NOTIFY_LOG'] = os.environ.get('NOTIFY_LOG', '')
 
 # MQTT Configuration
 app.config['MQTT_BROKER_URL'] = 'localhost'
 app.config['MQTT_BROKER_PORT'] = 1883
 app.config['MQTT_USERNAME'] = 'mqttuser'
 app.config['MQTT_PASSWORD'] = 'password'
-mqtt = Mqtt(app)
+# A fixed client id with a persistent session: the broker keeps QoS 1 messages
+# that were not acknowledged (journaled) before a crash and redelivers them.
+app.config['MQTT_CLIENT_ID'] = os.environ.get('MQTT_CLIENT_ID', f"pi-zero-ingest-{app.config['SITE_ID']}")
+app.config['MQTT_CLEAN_SESSION'] = False
+
+# Deployment role: 'all' runs everything in one process (development), 'ingest'
+# owns MQTT, alarm evaluation and writes, 'web' only serves HTTP and can run as
+# many workers as needed under a WSGI server.
+APP_ROLE = os.environ.get('APP_ROLE', 'all')
+ingest_lock = {'file': None}
+
+def acquire_ingest_lock():
+    """Take the instance-wide ingest lock so only one process ever subscribes."""
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock_file = open(os.path.join(app.instance_path, 'ingest.lock'), 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.truncate(0)
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    ingest_lock['file'] = lock_file
+    return True
+
+INGEST = APP_ROLE != 'web' and acquire_ingest_lock()
+if APP_ROLE != 'web' and not INGEST:
+    print("⚠️ Another process holds the ingest lock; this one will only serve HTTP.")
+
+# The broker connection is made by the client's network thread (which also
+# retries until the broker is reachable), so it overlaps the rest of startup.
+# Nothing is subscribed before the ingest path is ready: see subscribe_topics().
+mqtt = Mqtt(connect_async=True)
+if INGEST:
+    mqtt.init_app(app)
+    print("📶 Connecting to the MQTT broker in the background.")
+startup_phase('flask app + mqtt client')
+
+def mqtt_publish(topic, payload):
+    if INGEST:
+        mqtt.publish(topic, payload)
+        return
+    # HTTP-only processes keep no broker connection; toggles are rare enough for a one-shot publish.
+    try:
+        publish.single(topic, payload,
+                       hostname=app.config['MQTT_BROKER_URL'], port=app.config['MQTT_BROKER_PORT'],
+                       auth={'username': app.config['MQTT_USERNAME'], 'password': app.config['MQTT_PASSWORD']})
+    except Exception as e:
+        print(f"❌ Failed to publish {topic}: {e}")
+
+# SQLAlchemy is by far the slowest import; it loads while MQTT connects
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+startup_phase('import sqlalchemy')
 
 # SQLite Configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///distances.db'
@@ -32,43 +153,1010 @@ class DistanceReading(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     value = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Older databases get these from migration 0001
+    device = db.Column(db.String(32), nullable=False, default='pico', server_default='pico')
+    __table_args__ = (
+        db.Index('ix_distance_reading_timestamp', 'timestamp'),
+        db.Index('ix_distance_reading_device_timestamp', 'device', 'timestamp'),
+    )
 
 class AlarmEvent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(20), nullable=False)  # 'triggered' or 'toggled'
     detail = db.Column(db.String(120))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Older databases get the column from STARTUP_COLUMNS and the index from STARTUP_INDEXES
+    device = db.Column(db.String(32), nullable=False, default='pico', server_default='pico')
+    __table_args__ = (
+        db.Index('ix_alarm_event_type_timestamp', 'type', 'timestamp'),
+        db.Index('ix_alarm_event_timestamp', 'timestamp'),
+    )
 
 class PicoStatus(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String(10))  # "online" or "offline"
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    device = db.Column(db.String(32), nullable=False, default='pico', server_default='pico')
+
+class DistanceRollup(db.Model):
+    device = db.Column(db.String(32), primary_key=True, default='pico')
+    bucket = db.Column(db.DateTime, primary_key=True)  # start of the minute (UTC)
+    count = db.Column(db.Integer, nullable=False)
+    value_sum = db.Column(db.Float, nullable=False)
+    value_min = db.Column(db.Float, nullable=False)
+    value_max = db.Column(db.Float, nullable=False)
+    sketch = db.Column(db.LargeBinary)  # TDigest.to_bytes() of the minute's values
+
+class DistanceRollupHour(db.Model):
+    """A complete hour of DistanceRollup minutes merged into one row, for long ranges."""
+    device = db.Column(db.String(32), primary_key=True, default='pico')
+    bucket = db.Column(db.DateTime, primary_key=True)  # start of the hour (UTC)
+    count = db.Column(db.Integer, nullable=False)
+    value_sum = db.Column(db.Float, nullable=False)
+    value_min = db.Column(db.Float, nullable=False)
+    value_max = db.Column(db.Float, nullable=False)
+    sketch = db.Column(db.LargeBinary, nullable=False)
+
+class Episode(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    device = db.Column(db.String(32), nullable=False, default='pico')
+    started_at = db.Column(db.DateTime, nullable=False)
+    ended_at = db.Column(db.DateTime)  # NULL while the episode is still open
+    min_value = db.Column(db.Float, nullable=False)  # closest distance (cm)
+    samples = db.Column(db.Integer, nullable=False, default=1)
+    peak_band = db.Column(db.String(10), nullable=False)  # closest sampling band reached
+    __table_args__ = (
+        db.Index('ix_episode_device_started_at', 'device', 'started_at'),
+        db.Index('ix_episode_started_at', 'started_at'),  # ranges across all devices
+    )
+
+class NotificationOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(16), nullable=False, default='pushover', server_default='pushover')
+    category = db.Column(db.String(20), nullable=False)  # 'trigger', 'online', 'offline' or 'digest'
+    message = db.Column(db.String(512), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # 'pending', 'sent', 'failed' or 'expired'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_notification_outbox_status_id', 'status', 'id'),)
+
+class AlarmSetting(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # single row, id 1
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IngestCheckpoint(db.Model):
+    name = db.Column(db.String(32), primary_key=True)
+    lsn = db.Column(db.Integer, nullable=False, default=0)  # last journal record applied to the DB
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BackfillCheckpoint(db.Model):
+    job = db.Column(db.String(32), primary_key=True)  # see backfill.py
+    range_from = db.Column(db.DateTime, nullable=False)
+    range_until = db.Column(db.DateTime, nullable=False)
+    done_until = db.Column(db.DateTime, nullable=False)  # everything before this is written
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ForwardCursor(db.Model):
+    stream = db.Column(db.String(16), primary_key=True)  # 'readings' or 'events'
+    last_id = db.Column(db.Integer, nullable=False, default=0)  # acknowledged by the aggregator
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RemoteReading(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(64), nullable=False)
+    device = db.Column(db.String(32), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)  # the reading's id at the site
+    timestamp = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.UniqueConstraint('site', 'device', 'seq', name='uq_remote_reading_site_device_seq'),
+                      db.Index('ix_remote_reading_site_timestamp', 'site', 'timestamp'))
+
+class RemoteEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    site = db.Column(db.String(64), nullable=False)
+    device = db.Column(db.String(32), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)  # the event's id at the site
+    type = db.Column(db.String(20), nullable=False)
+    detail = db.Column(db.String(120))
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.UniqueConstraint('site', 'device', 'seq', name='uq_remote_event_site_device_seq'),)
+
+class SchemaMigration(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    status = db.Column(db.String(10), nullable=False)  # 'copying', 'cleanup' or 'done'
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    max_id = db.Column(db.Integer, nullable=False, default=0)
+    copied = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+startup_phase('models')
+
+# create_all() skips indexes on tables that already exist, and a table rebuild
+# by a migration drops them, so run_migrations() (re)applies these in the
+# background once the ingest path is up.
+STARTUP_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_distance_reading_device_timestamp ON distance_reading (device, timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_alarm_event_type_timestamp ON alarm_event (type, timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_alarm_event_timestamp ON alarm_event (timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_episode_started_at ON episode (started_at)',
+]
+# Nullable columns (or NOT NULL with a constant default) need no table
+# rebuild: SQLite adds them without touching rows
+STARTUP_COLUMNS = [
+    ('distance_rollup', 'sketch', 'BLOB'),
+    ('notification_outbox', 'channel', "VARCHAR(16) NOT NULL DEFAULT 'pushover'"),
+    ('pico_status', 'device', "VARCHAR(32) NOT NULL DEFAULT 'pico'"),
+    # The AlarmEvent model has it, so ORM reads and inserts need it before 0002 could finish
+    ('alarm_event', 'device', "VARCHAR(32) NOT NULL DEFAULT 'pico'"),
+]
 
 with app.app_context():
     db.create_all()
+    # WAL lets HTTP workers keep reading while the ingest process writes
+    db.session.execute(text('PRAGMA journal_mode=WAL'))
+    for table, column, column_type in STARTUP_COLUMNS:
+        if column not in [row[1] for row in db.session.execute(text(f'PRAGMA table_info("{table}")'))]:
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+    db.session.commit()
+startup_phase('schema')
+
+# Online schema migrations
+#
+# Each migration rebuilds one table as <table>__new while ingest keeps writing:
+# triggers dual-write every insert/update/delete into the new table, existing
+# rows are copied in small id-ordered chunks (progress is checkpointed in the
+# same transaction, so a restart resumes where it stopped) and the final swap
+# is a pair of renames inside a single transaction.
+MIGRATION_CHUNK_ROWS = 2000
+MIGRATION_CHUNK_PAUSE = 0.25  # seconds between chunks so ingest gets the write lock
+
+# 'select' expressions are formatted with r='' for the bulk copy and r='NEW.'
+# for the dual-write triggers.
+MIGRATIONS = [
+    {
+        'name': '0001_distance_reading_device',
+        'table': 'distance_reading',
+        'create': '''CREATE TABLE IF NOT EXISTS distance_reading__new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            value FLOAT NOT NULL,
+            timestamp DATETIME,
+            device VARCHAR(32) NOT NULL DEFAULT 'pico')''',
+        'indexes': [
+            'CREATE INDEX IF NOT EXISTS ix_distance_reading_timestamp ON distance_reading__new (timestamp)',
+        ],
+        'columns': ['id', 'value', 'timestamp', 'device'],
+        'select': ['{r}id', '{r}value', '{r}timestamp', "'pico'"],
+        'needed': lambda columns: 'device' not in columns,
+    },
+    {
+        'name': '0002_alarm_event_device',
+        'table': 'alarm_event',
+        'create': '''CREATE TABLE IF NOT EXISTS alarm_event__new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            type VARCHAR(20) NOT NULL,
+            detail VARCHAR(120),
+            timestamp DATETIME,
+            device VARCHAR(32) NOT NULL DEFAULT 'pico')''',
+        'indexes': [
+            'CREATE INDEX IF NOT EXISTS ix_alarm_event_timestamp ON alarm_event__new (timestamp)',
+        ],
+        'columns': ['id', 'type', 'detail', 'timestamp', 'device'],
+        'select': ['{r}id', '{r}type', '{r}detail', '{r}timestamp', "'pico'"],
+        'needed': lambda columns: 'device' not in columns,
+    },
+]
+
+def open_raw_db():
+    """Plain sqlite3 connection to distances.db in autocommit mode."""
+    with app.app_context():
+        path = db.engine.url.database
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def _set_migration(conn, name, **fields):
+    assignments = ', '.join(f'{k} = ?' for k in fields)
+    conn.execute(f'UPDATE schema_migration SET {assignments} WHERE name = ?', (*fields.values(), name))
+
+def run_migration(conn, spec):
+    name, table = spec['name'], spec['table']
+    new = f'{table}__new'
+    columns = ', '.join(spec['columns'])
+    copy_select = ', '.join(e.format(r='') for e in spec['select'])
+    trigger_values = ', '.join(e.format(r='NEW.') for e in spec['select'])
+
+    row = conn.execute('SELECT status, last_id, max_id FROM schema_migration WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        if not spec['needed'](_table_columns(conn, table)):
+            conn.execute("INSERT INTO schema_migration (name, status, last_id, max_id, copied, started_at, finished_at) "
+                         "VALUES (?, 'done', 0, 0, 0, ?, ?)", (name, datetime.utcnow(), datetime.utcnow()))
+            return
+        # Create the target table and start dual-writing before taking the copy horizon.
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(spec['create'])
+        for index_sql in spec.get('indexes', []):
+            conn.execute(index_sql)
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {table}__mig_ins AFTER INSERT ON {table} BEGIN '
+                     f'INSERT OR REPLACE INTO {new} ({columns}) VALUES ({trigger_values}); END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {table}__mig_upd AFTER UPDATE ON {table} BEGIN '
+                     f'INSERT OR REPLACE INTO {new} ({columns}) VALUES ({trigger_values}); END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {table}__mig_del AFTER DELETE ON {table} BEGIN '
+                     f'DELETE FROM {new} WHERE id = OLD.id; END')
+        max_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        conn.execute("INSERT INTO schema_migration (name, status, last_id, max_id, copied, started_at) "
+                     "VALUES (?, 'copying', 0, ?, 0, ?)", (name, max_id, datetime.utcnow()))
+        conn.execute('COMMIT')
+        status, last_id = 'copying', 0
+        print(f"🔧 Migration {name}: copying {max_id} rows of {table}")
+    else:
+        status, last_id, max_id = row
+
+    while status == 'copying' and last_id < max_id:
+        conn.execute('BEGIN IMMEDIATE')
+        upper = conn.execute(f'SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?',
+                             (last_id, max_id, MIGRATION_CHUNK_ROWS - 1)).fetchone()
+        upper = upper[0] if upper else max_id
+        # OR IGNORE: rows the triggers already wrote are newer than the source snapshot.
+        cur = conn.execute(f'INSERT OR IGNORE INTO {new} ({columns}) SELECT {copy_select} FROM {table} '
+                           f'WHERE id > ? AND id <= ?', (last_id, upper))
+        conn.execute('UPDATE schema_migration SET last_id = ?, copied = copied + ? WHERE name = ?',
+                     (upper, max(cur.rowcount, 0), name))
+        conn.execute('COMMIT')
+        last_id = upper
+        sleep(MIGRATION_CHUNK_PAUSE)
+
+    if status == 'copying':
+        # Atomic swap: the old table keeps its rows until the chunked cleanup below.
+        conn.execute('BEGIN IMMEDIATE')
+        for suffix in ('ins', 'upd', 'del'):
+            conn.execute(f'DROP TRIGGER IF EXISTS {table}__mig_{suffix}')
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}__old')
+        conn.execute(f'ALTER TABLE {new} RENAME TO {table}')
+        _set_migration(conn, name, status='cleanup')
+        conn.execute('COMMIT')
+        status = 'cleanup'
+        print(f"🔁 Migration {name}: swapped in new {table}")
+
+    if status == 'cleanup':
+        # Dropping a large table in one go would hold the write lock for seconds.
+        while True:
+            cur = conn.execute(f'DELETE FROM {table}__old WHERE id IN '
+                               f'(SELECT id FROM {table}__old LIMIT {MIGRATION_CHUNK_ROWS})')
+            if cur.rowcount <= 0:
+                break
+            sleep(MIGRATION_CHUNK_PAUSE)
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(f'DROP TABLE IF EXISTS {table}__old')
+        _set_migration(conn, name, status='done', finished_at=datetime.utcnow())
+        conn.execute('COMMIT')
+        print(f"✅ Migration {name} finished.")
+
+def run_migrations():
+    conn = open_raw_db()
+    try:
+        for spec in MIGRATIONS:
+            run_migration(conn, spec)
+        for index_sql in STARTUP_INDEXES:
+            conn.execute(index_sql)
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        print(f"❌ Migration failed: {e}")
+    finally:
+        conn.close()
+
+# Minute rollups
+#
+# Readings are aggregated per device and minute in memory and written out when
+# the minute rolls over (or, for a device that went quiet, by the liveness
+# tick), so long chart ranges never have to touch raw rows. The newest stored
+# minute may still be incomplete, so readers take it and anything after it
+# from distance_reading; at startup it is recomputed from there as well.
+# Hours whose minutes are all stored are merged into DistanceRollupHour, so
+# /api/stats over a month merges ~720 sketches instead of ~43,000. An hour
+# row, once it exists, takes late samples too; readers fall back to the
+# minutes of any hour without one.
+ROLLUP_SECONDS = 60
+ROLLUP_HOUR = timedelta(hours=1)
+ROLLUP_COMPACT_INTERVAL = 3600  # seconds between passes that build hour rows
+TDIGEST_COMPRESSION = 50  # at most ~2x this many centroids per sketch
+ROLLUP_SKETCH_COMPRESSION = 25  # minute sketches are stored smaller; merged ones use the default
+SKETCH_MAGIC = b'PZT1'
+rollup_lock = threading.Lock()
+open_rollups = {}  # device -> [bucket, count, sum, min, max, TDigest]
+
+def put_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def get_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+class TDigest:
+    """Merging t-digest: a bounded list of (mean, weight) centroids approximating
+    the distribution, with small centroids at the tails so p5/p95 stay accurate."""
+
+    def __init__(self, centroids=(), compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.centroids = list(centroids)
+        self.count = sum(w for _, w in self.centroids)
+        self.buffer = []
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        if len(self.buffer) >= 4 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        for centroid in other.centroids + other.buffer:
+            self.add(*centroid)
+
+    def _q_limit(self, q):
+        # Inverse of the k1 scale function one unit of k further along
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        merged = []
+        mean, weight = points[0]
+        done = 0.0
+        limit = self._q_limit(0.0)
+        for m, w in points[1:]:
+            if (done + weight + w) / self.count <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                merged.append((mean, weight))
+                done += weight
+                limit = self._q_limit(done / self.count)
+                mean, weight = m, w
+        merged.append((mean, weight))
+        self.centroids = merged
+
+    def quantile(self, q):
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.count
+        cumulative = 0.0
+        previous = None
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target < center:
+                if previous is None:
+                    return mean
+                prev_mean, prev_center = previous
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+            previous = (mean, center)
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def to_bytes(self, compression=None):
+        """SKETCH_MAGIC, a varint centroid count, then per centroid the zigzag varint
+        step from the previous mean in hundredths (of a cm) and the varint weight.
+        A smaller compression merges the centroids down first."""
+        if compression is not None and compression < self.compression:
+            smaller = TDigest(compression=compression)
+            smaller.merge(self)
+            return smaller.to_bytes()
+        self._compress()
+        out = bytearray(SKETCH_MAGIC)
+        put_varint(out, len(self.centroids))
+        previous = 0
+        for mean, weight in self.centroids:
+            scaled = round(mean * 100)
+            step = scaled - previous
+            put_varint(out, step * 2 if step >= 0 else -step * 2 - 1)
+            put_varint(out, round(weight))
+            previous = scaled
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data.startswith(SKETCH_MAGIC):
+            # Sketches stored before the compact encoding: float32 (mean, weight) pairs
+            values = array('f')
+            values.frombytes(data)
+            return cls(zip(values[::2], values[1::2]))
+        count, pos = get_varint(data, len(SKETCH_MAGIC))
+        centroids, scaled = [], 0
+        for _ in range(count):
+            step, pos = get_varint(data, pos)
+            weight, pos = get_varint(data, pos)
+            scaled += (step >> 1) ^ -(step & 1)
+            centroids.append((scaled / 100, weight))
+        return cls(centroids)
+
+def rollup_bucket(ts):
+    return ts.replace(second=0, microsecond=0)
+
+def hour_bucket(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def flush_rollup(device, bucket, count, total, low, high, sketch):
+    # A restart or late sample merges with the row already stored for the minute;
+    # sketches cannot be merged in SQL, so the stored one is folded in here.
+    stored = db.session.execute(
+        db.select(DistanceRollup.sketch).filter_by(device=device, bucket=bucket)).scalar()
+    merged = sketch
+    if stored:
+        merged = TDigest.from_bytes(stored)
+        merged.merge(sketch)
+    stmt = sqlite_insert(DistanceRollup).values(
+        device=device, bucket=bucket, count=count, value_sum=total, value_min=low, value_max=high,
+        sketch=merged.to_bytes(ROLLUP_SKETCH_COMPRESSION))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device', 'bucket'],
+        set_={
+            'count': DistanceRollup.count + stmt.excluded.count,
+            'value_sum': DistanceRollup.value_sum + stmt.excluded.value_sum,
+            'value_min': db.func.min(DistanceRollup.value_min, stmt.excluded.value_min),
+            'value_max': db.func.max(DistanceRollup.value_max, stmt.excluded.value_max),
+            'sketch': stmt.excluded.sketch,
+        })
+    db.session.execute(stmt)
+    # Checked after the write, which holds the lock compact_rollups() takes to build the hour
+    hour = db.session.get(DistanceRollupHour, (device, hour_bucket(bucket)))
+    if hour is not None:
+        hour_sketch = TDigest.from_bytes(hour.sketch)
+        hour_sketch.merge(sketch)
+        hour.count += count
+        hour.value_sum += total
+        hour.value_min = min(hour.value_min, low)
+        hour.value_max = max(hour.value_max, high)
+        hour.sketch = hour_sketch.to_bytes()
+
+def update_rollup(device, ts, value):
+    with rollup_lock:
+        _update_rollup(device, ts, value)
+
+def _update_rollup(device, ts, value):
+    """Add one reading (cm) to the open minute; only writing out a minute needs the app context."""
+    bucket = rollup_bucket(ts)
+    current = open_rollups.get(device)
+    if current is not None and current[0] == bucket:
+        current[1] += 1
+        current[2] += value
+        current[3] = min(current[3], value)
+        current[4] = max(current[4], value)
+        current[5].add(value)
+        return
+    if current is not None and bucket < current[0]:
+        # Late sample from a batch: merge it straight into its stored minute
+        with app.app_context():
+            flush_rollup(device, bucket, 1, value, value, value, TDigest([(value, 1)]))
+            db.session.commit()
+        return
+    if current is not None:
+        with app.app_context():
+            flush_rollup(device, *current)
+            db.session.commit()
+    open_rollups[device] = [bucket, 1, value, value, value, TDigest([(value, 1)])]
+
+def sweep_rollups(before=None):
+    """Write out open minutes that ended before `before` (all of them when None, at shutdown)."""
+    with rollup_lock:
+        ended = [d for d, current in open_rollups.items() if before is None or current[0] < before]
+        if not ended:
+            return
+        with app.app_context():
+            for device in ended:
+                flush_rollup(device, *open_rollups.pop(device))
+            db.session.commit()
+
+def rebuild_rollups():
+    """Recompute each device's newest stored minute and everything after it from raw
+    rows: a crash loses the open minute and a shutdown stores it half done. The
+    latest minute, if it has not ended yet, is reopened in memory."""
+    now = rollup_bucket(datetime.utcnow())
+    device_sql = reading_device_sql()
+    with rollup_lock, app.app_context():
+        newest = db.session.execute(text("SELECT device, MAX(bucket) FROM distance_rollup GROUP BY device")).all()
+        for device, since in newest:
+            minutes = {}
+            for ts, value in db.session.execute(text(
+                    f"SELECT timestamp, value FROM distance_reading WHERE {device_sql} = :device "
+                    "AND timestamp >= :since ORDER BY timestamp"), {'device': device, 'since': since}):
+                bucket = rollup_bucket(datetime.fromisoformat(ts))
+                minute = minutes.get(bucket)
+                if minute is None:
+                    minutes[bucket] = [1, value, value, value, TDigest([(value, 1)])]
+                    continue
+                minute[0] += 1
+                minute[1] += value
+                minute[2] = min(minute[2], value)
+                minute[3] = max(minute[3], value)
+                minute[4].add(value)
+            db.session.execute(text("DELETE FROM distance_rollup WHERE device = :device AND bucket >= :since"),
+                               {'device': device, 'since': since})
+            db.session.execute(text("DELETE FROM distance_rollup_hour WHERE device = :device AND bucket >= :hour"),
+                               {'device': device, 'hour': sql_ts(hour_bucket(datetime.fromisoformat(since)))})
+            if minutes and max(minutes) >= now:
+                latest = max(minutes)
+                open_rollups[device] = [latest, *minutes.pop(latest)]
+            for bucket, minute in minutes.items():
+                flush_rollup(device, bucket, *minute)
+            print(f"🧮 Rebuilt {len(minutes)} rollup minute(s) for {device} from raw readings")
+        db.session.commit()
 
-def set_pico_status(state):
+def compact_rollups():
+    """Merge every hour that ended before the device's newest stored minute, and so
+    has all its minutes, into a DistanceRollupHour row."""
+    with hot_db() as conn:
+        pending = conn.execute(
+            "SELECT r.device, substr(r.bucket, 1, 13) || ':00:00.000000' AS hour FROM distance_rollup r "
+            "JOIN (SELECT device, MAX(bucket) AS newest FROM distance_rollup GROUP BY device) n "
+            "ON n.device = r.device WHERE r.bucket < substr(n.newest, 1, 13) || ':00:00.000000' "
+            "AND NOT EXISTS (SELECT 1 FROM distance_rollup_hour h WHERE h.device = r.device "
+            "AND h.bucket = substr(r.bucket, 1, 13) || ':00:00.000000') "
+            "GROUP BY r.device, hour ORDER BY hour").fetchall()
+        for device, hour in pending:
+            end = sql_ts(datetime.fromisoformat(hour) + ROLLUP_HOUR)
+            conn.execute('BEGIN IMMEDIATE')  # a late sample for this hour waits, then lands in the row
+            digest = TDigest()
+            totals = [0, 0.0, math.inf, -math.inf]
+            for count, total, low, high, sketch in conn.execute(
+                    "SELECT count, value_sum, value_min, value_max, sketch FROM distance_rollup "
+                    "WHERE device = ? AND bucket >= ? AND bucket < ?", (device, hour, end)):
+                if sketch:
+                    digest.merge(TDigest.from_bytes(sketch))
+                else:
+                    digest.add(total / count, count)  # rollup written before sketches existed
+                totals = [totals[0] + count, totals[1] + total, min(totals[2], low), max(totals[3], high)]
+            conn.execute("INSERT OR REPLACE INTO distance_rollup_hour "
+                         "(device, bucket, count, value_sum, value_min, value_max, sketch) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (device, hour, *totals, digest.to_bytes()))
+            conn.execute('COMMIT')
+    if pending:
+        print(f"🗜️ Merged {len(pending)} rollup hour(s)")
+
+def compact_loop():
+    sleep(60)  # let startup work settle first
+    while True:
+        try:
+            compact_rollups()
+        except Exception as e:
+            print(f"❌ Rollup compaction failed: {e}")
+        sleep(ROLLUP_COMPACT_INTERVAL)
+
+# Intrusion episodes
+#
+# Consecutive readings inside EPISODE_THRESHOLD_CM form one episode, which
+# ends once nothing has been that close for EPISODE_GAP. Each reading only
+# touches the device's open episode in memory; the row is written when the
+# episode opens and again when it closes. A late sample from just before the
+# episode's start moves the start back; one from further back is ignored,
+# since the time it belongs to was already accounted for.
+EPISODE_THRESHOLD_CM = 100  # outer edge of the 'near' sampling band
+EPISODE_GAP = timedelta(seconds=5)
+EPISODE_SWEEP_AFTER = timedelta(seconds=60)  # close episodes of devices that went quiet
+open_episodes = {}  # device -> {'id', 'started', 'last', 'min', 'samples'}
+episode_lock = threading.Lock()
+
+def update_episode(device, ts, value):
+    """Fold one reading (cm) into the device's episode; only opening or closing one touches the DB."""
+    with episode_lock:
+        episode = open_episodes.get(device)
+        if episode is not None and ts - episode['last'] > EPISODE_GAP:
+            with app.app_context():
+                close_episode(device)
+            episode = None
+        if value >= EPISODE_THRESHOLD_CM:
+            return
+        if episode is not None:
+            if ts < episode['started'] - EPISODE_GAP:
+                return
+            episode['started'] = min(episode['started'], ts)
+            episode['last'] = max(episode['last'], ts)
+            episode['min'] = min(episode['min'], value)
+            episode['samples'] += 1
+            return
+        with app.app_context():
+            row = Episode(device=device, started_at=ts, min_value=value, samples=1,
+                          peak_band=SAMPLING_BANDS[sampling_band(value)][1])
+            db.session.add(row)
+            db.session.commit()
+            open_episodes[device] = {'id': row.id, 'started': ts, 'last': ts, 'min': value, 'samples': 1}
+    print(f"🚶 Episode started for {device} at {value:.1f} cm")
+    bus_publish('episode', device=device, state='open')
+
+def close_episode(device):
+    """Persist and forget the device's open episode; caller holds episode_lock."""
+    episode = open_episodes.pop(device)
+    db.session.query(Episode).filter_by(id=episode['id']).update({
+        'started_at': episode['started'],
+        'ended_at': episode['last'],
+        'min_value': episode['min'],
+        'samples': episode['samples'],
+        'peak_band': SAMPLING_BANDS[sampling_band(episode['min'])][1],
+    })
+    db.session.commit()
+    duration = (episode['last'] - episode['started']).total_seconds()
+    print(f"🚶 Episode ended for {device}: {duration:.0f}s, closest {episode['min']:.1f} cm")
+    bus_publish('episode', device=device, state='closed')
+
+def sweep_episodes():
+    now = datetime.utcnow()
+    with episode_lock, app.app_context():
+        for device in [d for d, e in open_episodes.items() if now - e['last'] > EPISODE_SWEEP_AFTER]:
+            close_episode(device)
+
+def close_orphaned_episodes():
+    """Episodes left open by a crash lost their in-memory progress; end them at their start."""
     with app.app_context():
-        existing = PicoStatus.query.first()
-        if existing:
-            existing.status = state
-            existing.timestamp = datetime.utcnow()
+        db.session.query(Episode).filter(Episode.ended_at.is_(None)).update({'ended_at': Episode.started_at})
+        db.session.commit()
+
+# Cross-process change notifications
+#
+# The ingest process listens on instance/bus.sock and relays every event to
+# all connected processes; HTTP-only processes connect to it and fall back to
+# polling PRAGMA data_version while it is unreachable. Events are JSON lines
+# such as {"event": "toggle", "enabled": false} and are always dispatched to
+# local handlers first.
+BUS_POLL_INTERVAL = 1.0  # seconds between data_version checks without the socket
+BUS_SEND_TIMEOUT = 2  # seconds before a stuck peer is dropped
+bus_handlers = {}
+bus_outbox = queue.Queue(maxsize=1000)
+bus_peers = []
+bus_peers_lock = threading.Lock()
+
+def bus_socket_path():
+    return os.path.join(app.instance_path, 'bus.sock')
+
+def on_bus(*events):
+    def register(handler):
+        for event in events:
+            bus_handlers.setdefault(event, []).append(handler)
+        return handler
+    return register
+
+def bus_dispatch(message):
+    for handler in bus_handlers.get(message.get('event'), ()):
+        try:
+            handler(message)
+        except Exception as e:
+            print(f"❌ Bus handler {handler.__name__} failed: {e}")
+
+def bus_publish(event, **data):
+    message = {'event': event, **data}
+    bus_dispatch(message)
+    try:
+        bus_outbox.put_nowait((None, (json.dumps(message) + '\n').encode()))
+    except queue.Full:
+        print(f"⚠️ Bus outbox full, dropped {event} event")
+
+def _bus_add_peer(peer):
+    peer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', BUS_SEND_TIMEOUT, 0))
+    with bus_peers_lock:
+        bus_peers.append(peer)
+
+def _bus_drop_peer(peer):
+    with bus_peers_lock:
+        if peer in bus_peers:
+            bus_peers.remove(peer)
+    try:
+        peer.close()
+    except OSError:
+        pass
+
+def _bus_send_loop():
+    while True:
+        origin, line = bus_outbox.get()
+        with bus_peers_lock:
+            peers = [p for p in bus_peers if p is not origin]
+        for peer in peers:
+            try:
+                peer.sendall(line)
+            except OSError:
+                _bus_drop_peer(peer)
+
+def _bus_read_loop(peer):
+    """Dispatch events from one peer until it disconnects; the hub relays them on."""
+    try:
+        for line in peer.makefile('rb'):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            bus_dispatch(message)
+            if INGEST:
+                try:
+                    bus_outbox.put_nowait((peer, line))
+                except queue.Full:
+                    pass
+    except OSError:
+        pass
+    finally:
+        _bus_drop_peer(peer)
+
+def _bus_serve():
+    path = bus_socket_path()
+    if os.path.exists(path):
+        os.unlink(path)  # left over from a previous ingest process; we hold the ingest lock
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    while True:
+        peer, _ = server.accept()
+        _bus_add_peer(peer)
+        threading.Thread(target=_bus_read_loop, args=(peer,), name='bus-peer', daemon=True).start()
+
+def _bus_client():
+    conn = None
+    last_version = None
+    while True:
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            peer.connect(bus_socket_path())
+        except OSError:
+            peer.close()
+            peer = None
+        if peer is not None:
+            print("🔗 Connected to the ingest event bus.")
+            _bus_add_peer(peer)
+            # Anything may have changed while we were not listening
+            bus_dispatch({'event': 'resync'})
+            _bus_read_loop(peer)
+            last_version = None
+            continue
+        if conn is None:
+            conn = open_raw_db()
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if last_version is not None and version != last_version:
+            bus_dispatch({'event': 'db_changed'})
+        last_version = version
+        sleep(BUS_POLL_INTERVAL)
+
+def start_bus():
+    threading.Thread(target=_bus_send_loop, name='bus-send', daemon=True).start()
+    target = _bus_serve if INGEST else _bus_client
+    threading.Thread(target=target, name='bus', daemon=True).start()
+
+# Hot-path data access
+#
+# Every reading and every dashboard poll goes through these, so they bypass
+# the ORM and the app context: pooled sqlite3 connections (each keeps its
+# prepared statements cached, so the SQL below is compiled once per
+# connection) and plain tuples back. The ORM stays for the admin and history
+# pages. `python bench_queries.py` compares both per operation.
+INSERT_READING_SQL = 'INSERT INTO distance_reading (timestamp, value, device) VALUES (?, ?, ?)'
+# Until migration 0001 has swapped in the new table there is no device column;
+# its dual-write trigger labels those rows 'pico'.
+INSERT_LEGACY_READING_SQL = 'INSERT INTO distance_reading (timestamp, value) VALUES (?, ?)'
+ADVANCE_CHECKPOINT_SQL = (
+    "INSERT INTO ingest_checkpoint (name, lsn, updated_at) VALUES ('journal', ?, ?) "
+    "ON CONFLICT (name) DO UPDATE SET lsn = max(lsn, excluded.lsn), updated_at = excluded.updated_at")
+# ROUND, not a bare CAST: julianday's float error would truncate 2.000 s to 1999 ms.
+EPOCH_MS_SQL = "CAST(ROUND((julianday({col}) - 2440587.5) * 86400000) AS INTEGER)"
+# {device} is filled in with reading_device_sql() when the query runs
+LATEST_READINGS_SQL = 'SELECT timestamp, value FROM distance_reading WHERE {device} = ? ORDER BY timestamp DESC LIMIT ?'
+READING_RANGE_SQL = ("SELECT " + EPOCH_MS_SQL.format(col='timestamp') + ", value FROM distance_reading "
+                     "WHERE {device} = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp")
+UPDATE_STATUS_SQL = ('UPDATE pico_status SET status = ?, timestamp = ? '
+                     'WHERE id = (SELECT MIN(id) FROM pico_status WHERE device = ?)')
+INSERT_STATUS_SQL = 'INSERT INTO pico_status (status, timestamp, device) VALUES (?, ?, ?)'
+CURRENT_STATUS_SQL = 'SELECT status FROM pico_status WHERE device = ? ORDER BY id LIMIT 1'
+hot_pool = queue.LifoQueue()  # idle connections; grows to the number of concurrent users
+reading_schema = {}  # 'device': True once migration 0001 has added the column, which it never loses
+
+@contextmanager
+def hot_db():
+    try:
+        conn = hot_pool.get_nowait()
+    except queue.Empty:
+        conn = open_raw_db()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        hot_pool.put(conn)
+
+def reading_device_sql():
+    """SQL for a reading's device; rows from before migration 0001 all came from the Pico."""
+    if not reading_schema.get('device'):
+        with hot_db() as conn:
+            reading_schema['device'] = 'device' in _table_columns(conn, 'distance_reading')
+    return 'device' if reading_schema['device'] else "'pico'"
+
+def save_readings(device, rows, lsn=None):
+    """Insert a device's (timestamp, cm) rows and advance the journal checkpoint in one transaction."""
+    device_sql = reading_device_sql()
+    with hot_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if device_sql == 'device':
+            conn.executemany(INSERT_READING_SQL, [(sql_ts(ts), cm, device) for ts, cm in rows])
         else:
-            new_status = PicoStatus(status=state)
-            db.session.add(new_status)
+            conn.executemany(INSERT_LEGACY_READING_SQL, [(sql_ts(ts), cm) for ts, cm in rows])
+        if lsn is not None:
+            conn.execute(ADVANCE_CHECKPOINT_SQL, (lsn, sql_ts(datetime.utcnow())))
+        conn.execute('COMMIT')
+
+def newest_readings(limit, device='pico'):
+    """The device's newest (timestamp, value) rows, newest first."""
+    sql = LATEST_READINGS_SQL.format(device=reading_device_sql())
+    with hot_db() as conn:
+        rows = conn.execute(sql, (device, limit)).fetchall()
+    return [(datetime.fromisoformat(ts), value) for ts, value in rows]
+
+def reading_range(start, end, device='pico'):
+    """The device's (epoch ms, value) rows with start <= timestamp < end, oldest first."""
+    sql = READING_RANGE_SQL.format(device=reading_device_sql())
+    with hot_db() as conn:
+        return conn.execute(sql, (device, sql_ts(start), sql_ts(end))).fetchall()
+
+def set_pico_status(state, device='pico'):
+    now = sql_ts(datetime.utcnow())
+    with hot_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if conn.execute(UPDATE_STATUS_SQL, (state, now, device)).rowcount == 0:
+            conn.execute(INSERT_STATUS_SQL, (state, now, device))
+        conn.execute('COMMIT')
+
+# Per-process dashboard caches, kept coherent through bus events
+latest_cache = {}
+status_cache = {}  # device -> 'online' / 'offline' / 'unknown'
+
+def latest_readings(device='pico'):
+    """The device's 10 newest (timestamp, value) pairs, newest first."""
+    readings = latest_cache.get(device)
+    if readings is None:
+        readings = latest_cache[device] = newest_readings(10, device)
+    return readings
+
+def current_pico_status(device='pico'):
+    status = status_cache.get(device)
+    if status is None:
+        with hot_db() as conn:
+            row = conn.execute(CURRENT_STATUS_SQL, (device,)).fetchone()
+        status = status_cache[device] = row[0] if row else "unknown"
+    return status
+
+def apply_alarm_state(enabled, version):
+    """Install a state in memory unless a newer version is already there."""
+    with alarm_state_lock:
+        if version > alarm_state['version']:
+            alarm_state['version'] = version
+            alarm_state['enabled'] = enabled
+
+def load_alarm_state():
+    """Read the persisted state, seeding it from the last toggle event on first run."""
+    with app.app_context():
+        setting = db.session.get(AlarmSetting, 1)
+        if setting is None:
+            last = AlarmEvent.query.filter_by(type='toggled').order_by(AlarmEvent.id.desc()).first()
+            setting = AlarmSetting(id=1, enabled=last is None or last.detail.endswith('ON'), version=1)
+            db.session.add(setting)
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()  # another process seeded it first
+                setting = db.session.get(AlarmSetting, 1)
+        apply_alarm_state(setting.enabled, setting.version)
+
+def set_alarm_enabled(enabled=None):
+    """Persist a new alarm state (None flips it) together with its AlarmEvent.
+
+    The flip happens inside the UPDATE, so concurrent toggles from different
+    workers serialise on SQLite's write lock instead of racing in memory.
+    """
+    with app.app_context():
+        new_value = text('1 - enabled') if enabled is None else int(enabled)
+        db.session.query(AlarmSetting).filter_by(id=1).update({
+            'enabled': new_value,
+            'version': AlarmSetting.version + 1,
+            'updated_at': datetime.utcnow(),
+        }, synchronize_session=False)
+        enabled, version = db.session.query(AlarmSetting.enabled, AlarmSetting.version).filter_by(id=1).one()
+        state = 'on' if enabled else 'off'
+        db.session.add(AlarmEvent(type='toggled', detail=f'Alarm turned {state.upper()}'))
         db.session.commit()
+    apply_alarm_state(enabled, version)
+    bus_publish('toggle', enabled=enabled, version=version)
+    return enabled
+
+@on_bus('reading')
+def _invalidate_latest(message):
+    latest_cache.pop(message.get('device', 'pico'), None)
+
+@on_bus('status')
+def _update_status(message):
+    status_cache[message.get('device', 'pico')] = message['status']
+
+@on_bus('toggle')
+def _apply_toggle(message):
+    apply_alarm_state(message['enabled'], message['version'])
+
+@on_bus('db_changed', 'resync')
+def _reload_all(message):
+    latest_cache.clear()
+    status_cache.clear()
+    load_alarm_state()
+
+# Server-sent events for dashboard clients
+SSE_MAX_SECONDS = 300  # browsers reconnect on their own; keeps WSGI threads from being held forever
+SSE_HEARTBEAT = 15
+sse_clients = set()
+sse_clients_lock = threading.Lock()
+
+@on_bus('reading', 'toggle', 'status', 'episode')
+def _feed_sse(message):
+    with sse_clients_lock:
+        clients = list(sse_clients)
+    for client_queue in clients:
+        try:
+            client_queue.put_nowait(message)
+        except queue.Full:
+            pass
+
+@app.route('/events')
+def events():
+    client_queue = queue.Queue(maxsize=100)
+
+    def stream():
+        with sse_clients_lock:
+            sse_clients.add(client_queue)
+        try:
+            yield 'retry: 2000\n\n'
+            deadline = monotonic() + SSE_MAX_SECONDS
+            while monotonic() < deadline:
+                try:
+                    message = client_queue.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            with sse_clients_lock:
+                sse_clients.discard(client_queue)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Jinja's from_string() (behind render_template_string) compiles on every call;
+# the page templates are compiled on first use instead, never at startup.
+compiled_templates = {}
+
+def compiled_template(source):
+    template = compiled_templates.get(source)
+    if template is None:
+        template = compiled_templates[source] = app.jinja_env.from_string(source)
+    return template
 
 @app.route('/')
 def home():
-    latest = DistanceReading.query.order_by(DistanceReading.timestamp.desc()).first()
-    readings = DistanceReading.query.order_by(DistanceReading.timestamp.desc()).limit(10).all()
-    labels = [r.timestamp.strftime("%H:%M:%S") for r in reversed(readings)]
-    values = [r.value for r in reversed(readings)]
-    status_obj = PicoStatus.query.first()
-    pico_status = status_obj.status if status_obj else "unknown"
+    readings = latest_readings()
+    labels = [ts.strftime("%H:%M:%S") for ts, _ in reversed(readings)]
+    values = [value for _, value in reversed(readings)]
+    pico_status = current_pico_status()
 
 
-    return render_template_string('''
+    return render_template(compiled_template('''
         <style>
             table {
                 border-collapse: collapse;
@@ -132,10 +1220,10 @@ def home():
                             </tr>
                         </thead>
                         <tbody id="distance-table-body">
-                            {% for r in readings %}
+                            {% for ts, value in readings %}
                             <tr>
-                                <td style="padding: 8px; border-bottom: 1px solid #ccc;">{{ r.timestamp.strftime('%Y-%m-%d %H:%M:%S') }}</td>
-                                <td style="padding: 8px; border-bottom: 1px solid #ccc;">{{ r.value }}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #ccc;">{{ ts.strftime('%Y-%m-%d %H:%M:%S') }}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #ccc;">{{ value }}</td>
                             </tr>
                             {% endfor %}
                         </tbody>
@@ -144,11 +1232,36 @@ def home():
 
                 <!-- Chart Section -->
                 <div style="flex: 2 1 700px; min-width: 450px;">
+                    <div id="chart-ranges" style="display: flex; gap: 8px; margin-bottom: 10px;">
+                        <button data-range="live" style="padding: 6px 12px; border: 2px solid black; border-radius: 6px; font-weight: bold; background-color: #6c63ff; color: white;">Live</button>
+                        <button data-range="3600" style="padding: 6px 12px; border: 2px solid black; border-radius: 6px; font-weight: bold;">1h</button>
+                        <button data-range="86400" style="padding: 6px 12px; border: 2px solid black; border-radius: 6px; font-weight: bold;">24h</button>
+                        <button data-range="604800" style="padding: 6px 12px; border: 2px solid black; border-radius: 6px; font-weight: bold;">7d</button>
+                        <button data-range="2592000" style="padding: 6px 12px; border: 2px solid black; border-radius: 6px; font-weight: bold;">30d</button>
+                    </div>
                     <canvas id="distanceChart" style="width: 100%; height: 400px; border: 3px solid black; border-radius: 8px;"></canvas>
                 </div>
             </div>
         </div>
 
+        <div style="margin-top: 40px;">
+            <h2>Intrusion Episodes</h2>
+            <p style="font-size: 18px;"><span id="episode-count">--</span> approaches in the last 7 days</p>
+            <div style="max-width: 700px; border: 3px solid black; border-radius: 10px; overflow: hidden;">
+                <table style="width: 100%; border-collapse: collapse; font-weight: bold;">
+                    <thead>
+                        <tr style="background-color: #f0f0f0;">
+                            <th style="border-bottom: 2px solid black; padding: 10px; text-align: left;">Start</th>
+                            <th style="border-bottom: 2px solid black; padding: 10px; text-align: left;">Duration</th>
+                            <th style="border-bottom: 2px solid black; padding: 10px; text-align: left;">Closest (cm)</th>
+                            <th style="border-bottom: 2px solid black; padding: 10px; text-align: left;">Band</th>
+                        </tr>
+                    </thead>
+                    <tbody id="episode-table-body"></tbody>
+                </table>
+            </div>
+        </div>
+
         <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
         <script>
             const ctx = document.getElementById('distanceChart').getContext('2d');
@@ -190,9 +1303,11 @@ def home():
                     .then(response => response.json())
                     .then(data => {
                         // Chart update
-                        distanceChart.data.labels = data.labels;
-                        distanceChart.data.datasets[0].data = data.values;
-                        distanceChart.update();
+                        if (chartRange === 'live') {
+                            distanceChart.data.labels = data.labels;
+                            distanceChart.data.datasets[0].data = data.values;
+                            distanceChart.update();
+                        }
 
                         // Status update
                         const alertBox = document.getElementById('distance-alert');
@@ -228,6 +1343,56 @@ def home():
                     });
             }
 
+            // Binary series: 'PZS1', uint32 count, int64 ms timestamps, float32 values (little-endian)
+            function decodeSeries(buffer) {
+                const view = new DataView(buffer);
+                const count = view.getUint32(4, true);
+                return {
+                    t: new BigInt64Array(buffer, 8, count),
+                    values: new Float32Array(buffer, 8 + 8 * count, count)
+                };
+            }
+
+            // Chart range selection: 'live' follows /latest, otherwise seconds of history
+            let chartRange = 'live';
+
+            function fetchChartRange() {
+                if (chartRange === 'live') return;
+                const seconds = Number(chartRange);
+                const from = Date.now() / 1000 - seconds;
+                fetch(`/api/chart?from=${from}&points=500`, { headers: { 'Accept': 'application/octet-stream' } })
+                    .then(response => response.arrayBuffer())
+                    .then(buffer => {
+                        const series = decodeSeries(buffer);
+                        distanceChart.data.labels = Array.from(series.t, ms => {
+                            const d = new Date(Number(ms));
+                            return seconds > 86400 ? d.toLocaleString([], {month: 'short', day: 'numeric', hour: '2-digit', minute: '2-digit'})
+                                                   : d.toLocaleTimeString();
+                        });
+                        distanceChart.data.datasets[0].data = Array.from(series.values, v => Math.round(v * 10) / 10);
+                        distanceChart.data.datasets[0].pointRadius = series.values.length > 50 ? 0 : 3;
+                        distanceChart.update();
+                    });
+            }
+
+            document.querySelectorAll('#chart-ranges button').forEach(btn => {
+                btn.addEventListener('click', () => {
+                    chartRange = btn.dataset.range;
+                    document.querySelectorAll('#chart-ranges button').forEach(b => {
+                        b.style.backgroundColor = b === btn ? '#6c63ff' : '';
+                        b.style.color = b === btn ? 'white' : '';
+                    });
+                    distanceChart.data.datasets[0].pointRadius = 3;
+                    if (chartRange === 'live') {
+                        fetchLatest();
+                    } else {
+                        fetchChartRange();
+                    }
+                });
+            });
+
+            setInterval(fetchChartRange, 60000);
+
             function fetchAlarmState() {
                 fetch('/alarm/state')
                     .then(response => response.json())
@@ -281,6 +1446,29 @@ def home():
                     });
            }
 
+           function fetchEpisodes() {
+               fetch('/api/episodes?limit=5')
+                   .then(res => res.json())
+                   .then(data => {
+                       document.getElementById('episode-count').textContent = data.count;
+                       const tbody = document.getElementById('episode-table-body');
+                       tbody.innerHTML = '';
+                       data.episodes.forEach(e => {
+                           const row = document.createElement('tr');
+                           [e.start.slice(0, 19).replace('T', ' '),
+                            e.duration_s + ' s' + (e.end ? '' : ' (ongoing)'),
+                            e.min_cm, e.peak_band].forEach(text => {
+                               const cell = document.createElement('td');
+                               cell.style.padding = '8px';
+                               cell.style.borderBottom = '1px solid #ccc';
+                               cell.textContent = text;
+                               row.appendChild(cell);
+                           });
+                           tbody.appendChild(row);
+                       });
+                   });
+           }
+
 	   document.getElementById("toggle-alarm").addEventListener("click", () => {
                fetch('/alarm/toggle')
                    .then(() => {
@@ -289,57 +1477,683 @@ def home():
   	   });
 
 
+           // Live updates pushed by the server; polling only runs while they are unavailable
+           let liveEvents = false;
+           let latestPending = null;
+           const events = new EventSource('/events');
+           events.onopen = () => { liveEvents = true; };
+           events.onerror = () => { liveEvents = false; };
+           events.addEventListener('reading', () => {
+               // Coalesce bursts of readings into one refresh
+               if (latestPending === null) {
+                   latestPending = setTimeout(() => { latestPending = null; fetchLatest(); }, 500);
+               }
+           });
+           events.addEventListener('toggle', fetchAlarmState);
+           events.addEventListener('status', () => { fetchPicoStatus(); fetchAlarmState(); });
+           events.addEventListener('episode', fetchEpisodes);
+
+           fetchAlarmState();
+           fetchPicoStatus();
+           fetchEpisodes();
+
            setInterval(() => {
+               if (liveEvents) return;
     	       fetchLatest();
     	       fetchAlarmState();
                fetchPicoStatus();
+               fetchEpisodes();
            }, 5000);
 
         </script>
-    ''', distance=latest.value if latest else None, readings=readings, labels=labels, values=values, pico_status=pico_status)
+    '''), distance=readings[0][1] if readings else None, readings=readings, labels=labels, values=values, pico_status=pico_status)
 
 @app.route('/latest')
 def latest():
-    readings = DistanceReading.query.order_by(DistanceReading.timestamp.desc()).limit(10).all()
-    labels = [r.timestamp.strftime("%H:%M:%S") for r in reversed(readings)]
-    values = [r.value for r in reversed(readings)]
+    readings = latest_readings(request.args.get('device', 'pico'))
+    if wants_binary_series():
+        return series_response([to_epoch_ms(ts) for ts, _ in reversed(readings)],
+                               [value for _, value in reversed(readings)])
+    labels = [ts.strftime("%H:%M:%S") for ts, _ in reversed(readings)]
+    values = [value for _, value in reversed(readings)]
     latest_value = values[-1] if values else None
-    rows = [{"time": r.timestamp.strftime('%Y-%m-%d %H:%M:%S'), "value": r.value} for r in readings]
+    rows = [{"time": ts.strftime('%Y-%m-%d %H:%M:%S'), "value": value} for ts, value in readings]
 
-    return jsonify({
+    response = jsonify({
         "latest": latest_value,
         "labels": labels,
         "values": values,
         "rows": rows
     })
+    response.vary.add('Accept')
+    return response
+
+# Downsampled chart series
+CHART_MAX_POINTS = 2000
+CHART_RAW_SPAN = timedelta(hours=6)  # longer ranges are drawn from minute rollups
+
+def parse_time_arg(value, default):
+    """Accept epoch seconds or an ISO timestamp from a query string, as naive UTC.
+    Anything else raises ValueError."""
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        ts = datetime.fromisoformat(value)
+        # Without an offset the time is taken as UTC already
+        return ts if ts.tzinfo is None else ts.astimezone(timezone.utc).replace(tzinfo=None)
+    try:
+        return datetime.utcfromtimestamp(seconds)
+    except (OverflowError, OSError):
+        raise ValueError(f'timestamp out of range: {value}')
+
+def parse_until_arg(value, default):
+    """parse_time_arg for an exclusive end, where a bare date includes the whole day."""
+    until = parse_time_arg(value, default)
+    if value and re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        until += timedelta(days=1)
+    return until
+
+def sql_ts(ts):
+    """Format a datetime the way SQLAlchemy stores DateTime columns in SQLite."""
+    return ts.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def to_epoch_ms(ts):
+    return round((ts - datetime(1970, 1, 1)) / timedelta(milliseconds=1))
+
+def lttb(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets downsampling of an x-sorted series."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return xs, ys
+    out_x, out_y = [xs[0]], [ys[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - end
+        avg_x = sum(xs[end:next_end]) / span
+        avg_y = sum(ys[end:next_end]) / span
+        ax, ay = xs[a], ys[a]
+        dx, dy = ax - avg_x, avg_y - ay
+        best_area, best = -1.0, start
+        for j in range(start, end):
+            area = abs(dx * (ys[j] - ay) - (ax - xs[j]) * dy)
+            if area > best_area:
+                best_area, best = area, j
+        out_x.append(xs[best])
+        out_y.append(ys[best])
+        a = best
+    out_x.append(xs[-1])
+    out_y.append(ys[-1])
+    return out_x, out_y
+
+def raw_series(start, end, device='pico'):
+    xs, ys = archive_series(start, end, device)
+    archived = len(xs)
+    for x, y in reading_range(start, end, device):
+        xs.append(x)
+        ys.append(y)
+    if archived and len(xs) > archived and xs[archived] < xs[archived - 1]:
+        # Rows arrived for an archived day after it was archived; they wait for the next run
+        points = sorted(zip(xs, ys))
+        xs, ys = [x for x, _ in points], [y for _, y in points]
+    return xs, ys
+
+def bucket_series(rows, xs, ys):
+    """Expand (bucket_ms, count, avg, min, max) rows into min/max point pairs."""
+    for bucket_ms, count, avg, low, high in rows:
+        if count == 1:
+            xs.append(bucket_ms + 30000)
+            ys.append(avg)
+        else:
+            xs.append(bucket_ms + 20000)
+            ys.append(low)
+            xs.append(bucket_ms + 40000)
+            ys.append(high)
+
+def minute_buckets(xs, ys):
+    """Group a sorted (epoch ms, value) series into (bucket_ms, count, avg, min, max) rows."""
+    rows = []
+    for x, y in zip(xs, ys):
+        bucket = x // 60000 * 60000
+        if rows and rows[-1][0] == bucket:
+            row = rows[-1]
+            row[1] += 1
+            row[2] += y
+            row[3] = min(row[3], y)
+            row[4] = max(row[4], y)
+        else:
+            rows.append([bucket, 1, y, y, y])
+    return [(bucket, count, total / count, low, high) for bucket, count, total, low, high in rows]
+
+def rollup_split(device, start, end):
+    """(split, tail): stored rollups cover [split, tail) of [start, end). Before split
+    data only exists as raw rows; the newest stored minute may be incomplete, so it
+    and everything after it are read raw as well."""
+    first, newest = db.session.execute(text(
+        "SELECT (SELECT MIN(bucket) FROM distance_rollup WHERE device = :device), "
+        "(SELECT MAX(bucket) FROM distance_rollup WHERE device = :device)"), {'device': device}).one()
+    first, newest = (datetime.fromisoformat(v) if isinstance(v, str) else v for v in (first, newest))
+    split = min(max(first or end, start), end)
+    return split, min(max(newest or end, split), end)
+
+def raw_minute_rows(start, end, device):
+    return db.session.execute(text(
+        f"SELECT {EPOCH_MS_SQL.format(col='timestamp')} / 60000 * 60000 AS b, COUNT(*), AVG(value), MIN(value), MAX(value) "
+        f"FROM distance_reading WHERE {reading_device_sql()} = :device AND timestamp >= :start AND timestamp < :end "
+        "GROUP BY b ORDER BY b"),
+        {'device': device, 'start': sql_ts(start), 'end': sql_ts(end)})
+
+def rollup_series(start, end, device='pico'):
+    """Minute-bucketed series: stored rollups where they are complete, raw GROUP BY elsewhere."""
+    xs, ys = [], []
+    split, tail = rollup_split(device, start, end)
+    if split > start:
+        archived_xs, archived_ys = archive_series(start, split, device)
+        bucket_series(minute_buckets(archived_xs, archived_ys), xs, ys)
+        bucket_series(raw_minute_rows(start, split, device), xs, ys)
+    if split < tail:
+        bucket_series(db.session.execute(text(
+            f"SELECT {EPOCH_MS_SQL.format(col='bucket')}, count, value_sum / count, value_min, value_max "
+            "FROM distance_rollup WHERE device = :device AND bucket >= :start AND bucket < :end ORDER BY bucket"),
+            {'device': device, 'start': sql_ts(split), 'end': sql_ts(tail)}), xs, ys)
+    if tail < end:
+        bucket_series(raw_minute_rows(tail, end, device), xs, ys)
+    return xs, ys
+
+# Binary series format: b'PZS1', uint32 count, then count int64 epoch-ms
+# timestamps followed by count float32 values, all little-endian. PZS2 is the
+# same with float64 values; the archive uses it so readings keep full precision.
+SERIES_MAGIC = b'PZS1'
+ARCHIVE_SERIES_MAGIC = b'PZS2'
+SERIES_VALUE_TYPES = {SERIES_MAGIC: 'f', ARCHIVE_SERIES_MAGIC: 'd'}
+SERIES_MIMETYPE = 'application/octet-stream'
+
+def wants_binary_series():
+    return request.accept_mimetypes.best_match(['application/json', SERIES_MIMETYPE]) == SERIES_MIMETYPE
+
+def pack_series(xs, ys, magic=SERIES_MAGIC):
+    times, values = array('q', xs), array(SERIES_VALUE_TYPES[magic], ys)
+    if sys.byteorder == 'big':
+        times.byteswap()
+        values.byteswap()
+    return magic + struct.pack('<I', len(times)) + times.tobytes() + values.tobytes()
+
+def series_response(xs, ys, **headers):
+    response = Response(pack_series(xs, ys), mimetype=SERIES_MIMETYPE)
+    for name, value in headers.items():
+        response.headers['X-Series-' + name.capitalize()] = str(value)
+    response.vary.add('Accept')
+    return response
+
+def unpack_series(data):
+    """Inverse of pack_series() for either magic: (array of epoch ms, array of values)."""
+    magic = bytes(data[:4])
+    if magic not in SERIES_VALUE_TYPES:
+        raise ValueError('not a PZS1/PZS2 series')
+    count = struct.unpack_from('<I', data, 4)[0]
+    times, values = array('q'), array(SERIES_VALUE_TYPES[magic])
+    times.frombytes(data[8:8 + 8 * count])
+    values.frombytes(data[8 + 8 * count:8 + 8 * count + values.itemsize * count])
+    if sys.byteorder == 'big':
+        times.byteswap()
+        values.byteswap()
+    return times, values
+
+# Cold archive
+#
+# Readings older than ARCHIVE_AFTER_DAYS move out of SQLite into one gzipped
+# PZS2 file per device and UTC day under instance/archive (older PZS1 files are
+# still read). A file is never modified in place: late rows for an archived day
+# produce a replacement file.
+# manifest.json records each file's time and value range plus the highest
+# reading id it contains, so an interrupted move resumes without duplicates
+# and range queries only open the files that overlap.
+ARCHIVE_DIR = os.path.join(app.instance_path, 'archive')
+ARCHIVE_MANIFEST = os.path.join(ARCHIVE_DIR, 'manifest.json')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))  # 0 disables archiving
+ARCHIVE_INTERVAL = 6 * 3600  # seconds between archive runs
+ARCHIVE_DELETE_CHUNK = 1000  # rows per delete transaction
+ARCHIVE_DELETE_PAUSE = 0.05  # seconds
+ARCHIVE_CACHE_FILES = 4  # decompressed days kept in memory per process
+archive_manifest = {'mtime': None, 'files': {}}
+archive_cache = OrderedDict()
+archive_lock = threading.Lock()
+
+def load_manifest():
+    """The manifest's file table, re-read only when another process has replaced it."""
+    try:
+        mtime = os.stat(ARCHIVE_MANIFEST).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != archive_manifest['mtime']:
+        with open(ARCHIVE_MANIFEST) as f:
+            archive_manifest['files'] = json.load(f)['files']
+        archive_manifest['mtime'] = mtime
+        archive_cache.clear()
+    return archive_manifest['files']
+
+def write_atomically(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def read_archive_file(name):
+    with archive_lock:
+        if name in archive_cache:
+            archive_cache.move_to_end(name)
+            return archive_cache[name]
+    with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rb') as f:
+        series = unpack_series(f.read())
+    with archive_lock:
+        archive_cache[name] = series
+        while len(archive_cache) > ARCHIVE_CACHE_FILES:
+            archive_cache.popitem(last=False)
+    return series
+
+def archive_series(start, end, device='pico'):
+    """Archived (epoch ms, value) lists within [start, end), oldest first."""
+    start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+    xs, ys = [], []
+    entries = sorted((entry['t_min'], name) for name, entry in load_manifest().items()
+                     if entry['device'] == device and entry['t_max'] >= start_ms and entry['t_min'] < end_ms)
+    for _, name in entries:
+        times, values = read_archive_file(name)
+        lo, hi = bisect.bisect_left(times, start_ms), bisect.bisect_left(times, end_ms)
+        xs.extend(times[lo:hi])
+        ys.extend(values[lo:hi])
+    return xs, ys
+
+def archived_until():
+    """Start of the first day that has not been archived (None if nothing has)."""
+    days = [entry['day'] for entry in load_manifest().values()]
+    return datetime.fromisoformat(max(days)) + timedelta(days=1) if days else None
+
+def archive_day(conn, device, day):
+    """Move one device-day of readings into its archive file, then delete them in chunks."""
+    name = f"{device}/{day:%Y-%m-%d}.pzs.gz"
+    files = dict(load_manifest())
+    entry = files.get(name)
+    bounds = (sql_ts(day), sql_ts(day + timedelta(days=1)))
+    archived_id = entry['max_id'] if entry else 0
+    rows = conn.execute(
+        f"SELECT id, {EPOCH_MS_SQL.format(col='timestamp')}, value FROM distance_reading "
+        "WHERE timestamp >= ? AND timestamp < ? AND device = ? AND id > ?", (*bounds, device, archived_id)).fetchall()
+    if rows:
+        points = sorted((t, value) for _, t, value in rows)
+        if entry:
+            times, values = read_archive_file(name)
+            points = sorted(list(zip(times, values)) + points)  # late rows for a day already archived
+        xs, ys = [t for t, _ in points], [v for _, v in points]
+        os.makedirs(os.path.join(ARCHIVE_DIR, device), exist_ok=True)
+        write_atomically(os.path.join(ARCHIVE_DIR, name), gzip.compress(pack_series(xs, ys, ARCHIVE_SERIES_MAGIC)))
+        files[name] = {'device': device, 'day': f"{day:%Y-%m-%d}", 'count': len(xs),
+                       't_min': xs[0], 't_max': xs[-1], 'v_min': min(ys), 'v_max': max(ys),
+                       'max_id': max(archived_id, max(row[0] for row in rows))}
+        write_atomically(ARCHIVE_MANIFEST, json.dumps({'version': 1, 'files': files}, indent=1).encode())
+    # Only rows the manifest vouches for are deleted, so a crash at any point loses nothing
+    max_id = files[name]['max_id'] if name in files else 0
+    deleted = 0
+    while True:
+        cursor = conn.execute(
+            "DELETE FROM distance_reading WHERE id IN (SELECT id FROM distance_reading "
+            "WHERE timestamp >= ? AND timestamp < ? AND device = ? AND id <= ? LIMIT ?)",
+            (*bounds, device, max_id, ARCHIVE_DELETE_CHUNK))
+        deleted += cursor.rowcount
+        if cursor.rowcount < ARCHIVE_DELETE_CHUNK:
+            break
+        sleep(ARCHIVE_DELETE_PAUSE)
+    return deleted
+
+def run_archive():
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    conn = open_raw_db()
+    try:
+        if 'device' not in _table_columns(conn, 'distance_reading'):
+            return 0  # wait for migration 0001
+        cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=ARCHIVE_AFTER_DAYS)
+        moved = 0
+        oldest = conn.execute('SELECT MIN(timestamp) FROM distance_reading').fetchone()[0]
+        while oldest is not None:
+            day = datetime.fromisoformat(oldest).replace(hour=0, minute=0, second=0, microsecond=0)
+            if day >= cutoff:
+                break
+            next_day = sql_ts(day + timedelta(days=1))
+            for (device,) in conn.execute('SELECT DISTINCT device FROM distance_reading WHERE timestamp >= ? AND timestamp < ?',
+                                          (sql_ts(day), next_day)).fetchall():
+                moved += archive_day(conn, device, day)
+            oldest = conn.execute('SELECT MIN(timestamp) FROM distance_reading WHERE timestamp >= ?',
+                                  (next_day,)).fetchone()[0]
+        if moved:
+            print(f"🧊 Archived {moved} readings older than {cutoff:%Y-%m-%d}")
+        return moved
+    finally:
+        conn.close()
+
+def archive_loop():
+    sleep(60)  # let startup work settle first
+    while True:
+        try:
+            run_archive()
+        except Exception as e:
+            print(f"❌ Archiving failed: {e}")
+        sleep(ARCHIVE_INTERVAL)
 
-@app.route('/alarm/toggle')
-def toggle_alarm():
-    alarm_state['enabled'] = not alarm_state['enabled']
-    state = 'on' if alarm_state['enabled'] else 'off'
-    mqtt.publish('device/alarm', state)
+@app.route('/api/chart')
+def api_chart():
+    try:
+        end = parse_time_arg(request.args.get('to'), datetime.utcnow())
+        start = parse_time_arg(request.args.get('from'), end - timedelta(hours=1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    device = request.args.get('device', 'pico')
+    points = min(max(request.args.get('points', 500, type=int), 3), CHART_MAX_POINTS)
+    if end - start <= CHART_RAW_SPAN:
+        source = 'raw'
+        xs, ys = raw_series(start, end, device)
+    else:
+        source = 'rollup'
+        xs, ys = rollup_series(start, end, device)
+    xs, ys = lttb(xs, ys, points)
+    if wants_binary_series():
+        return series_response(xs, ys, source=source, start=to_epoch_ms(start), end=to_epoch_ms(end))
+    response = jsonify({
+        'from': to_epoch_ms(start),
+        'to': to_epoch_ms(end),
+        'source': source,
+        't': xs,
+        'values': ys,
+    })
+    response.vary.add('Accept')
+    return response
 
-    with app.app_context():
-        event = AlarmEvent(type='toggled', detail=f'Alarm turned {state.upper()}')
-        db.session.add(event)
-        db.session.commit()
+READINGS_MAX_POINTS = 100000
 
+@app.route('/api/readings')
+def api_readings():
+    """Raw readings in a range, from SQLite and the archive alike; `next` continues a truncated range."""
+    try:
+        end = parse_time_arg(request.args.get('to'), datetime.utcnow())
+        start = parse_time_arg(request.args.get('from'), end - timedelta(hours=1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(max(request.args.get('limit', 10000, type=int), 1), READINGS_MAX_POINTS)
+    xs, ys = raw_series(start, end, request.args.get('device', 'pico'))
+    next_from = None
+    if len(xs) > limit:
+        next_from = xs[limit] / 1000
+        xs, ys = xs[:limit], ys[:limit]
+    if wants_binary_series():
+        return series_response(xs, ys, start=to_epoch_ms(start), end=to_epoch_ms(end), **(
+            {'next': next_from} if next_from is not None else {}))
+    response = jsonify({
+        'from': to_epoch_ms(start),
+        'to': to_epoch_ms(end),
+        'next': next_from,
+        't': xs,
+        'values': ys,
+    })
+    response.vary.add('Accept')
+    return response
+
+# Percentiles are answered by merging the per-minute sketches, so the cost
+# grows with the number of minutes in the range, never with the readings.
+STATS_QUANTILES = (('p5', 0.05), ('p50', 0.5), ('p95', 0.95))
+
+def parse_hours(value):
+    """'22-6' -> the UTC hours 22, 23, 0, ..., 5; a single '3' -> [3]; None for all hours."""
+    if not value:
+        return None
+    first, _, last = value.partition('-')
+    first = int(first) % 24
+    last = int(last) % 24 if last else (first + 1) % 24
+    return [(first + i) % 24 for i in range((last - first) % 24 or 24)]
+
+@app.route('/api/stats')
+def api_stats():
+    try:
+        end = parse_time_arg(request.args.get('to'), datetime.utcnow())
+        start = parse_time_arg(request.args.get('from'), end - timedelta(hours=24))
+        hours = parse_hours(request.args.get('hours'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    device = request.args.get('device', 'pico')
+    hour_filter = '' if hours is None else \
+        f" AND CAST(strftime('%H', {{col}}) AS INTEGER) IN ({', '.join(map(str, hours))})"
+
+    digest = TDigest()
+    totals = {'count': 0, 'sum': 0.0, 'min': math.inf, 'max': -math.inf}
+    def add_summary(count, total, low, high):
+        totals['count'] += count
+        totals['sum'] += total
+        totals['min'] = min(totals['min'], low)
+        totals['max'] = max(totals['max'], high)
+
+    split, tail = rollup_split(device, start, end)
+    if split > start:
+        # Readings from before the device's first rollup are streamed row by row
+        archived_xs, archived_ys = archive_series(start, split, device)
+        for x, value in zip(archived_xs, archived_ys):
+            if hours is None or datetime.utcfromtimestamp(x / 1000).hour in hours:
+                digest.add(value)
+                add_summary(1, value, value, value)
+        for (value,) in db.session.execute(text(
+                f"SELECT value FROM distance_reading WHERE timestamp >= :start AND timestamp < :end "
+                f"AND {reading_device_sql()} = :device" + hour_filter.format(col='timestamp')),
+                {'device': device, 'start': sql_ts(start), 'end': sql_ts(split)}):
+            digest.add(value)
+            add_summary(1, value, value, value)
+    # Whole hours come from the hour rows; minutes fill the edges and any hour not merged yet
+    minute_ranges, covered = [], split
+    first_hour, last_hour = hour_bucket(split + ROLLUP_HOUR - timedelta(microseconds=1)), hour_bucket(tail)
+    if first_hour < last_hour:
+        for bucket, count, total, low, high, sketch in db.session.execute(text(
+                "SELECT bucket, count, value_sum, value_min, value_max, sketch FROM distance_rollup_hour "
+                "WHERE device = :device AND bucket >= :start AND bucket < :end ORDER BY bucket"),
+                {'device': device, 'start': sql_ts(first_hour), 'end': sql_ts(last_hour)}):
+            bucket = datetime.fromisoformat(bucket)
+            if bucket > covered:
+                minute_ranges.append((covered, bucket))
+            covered = bucket + ROLLUP_HOUR
+            if hours is None or bucket.hour in hours:
+                digest.merge(TDigest.from_bytes(sketch))
+                add_summary(count, total, low, high)
+    if covered < tail:
+        minute_ranges.append((covered, tail))
+    for range_start, range_end in minute_ranges:
+        for count, total, low, high, sketch in db.session.execute(text(
+                "SELECT count, value_sum, value_min, value_max, sketch FROM distance_rollup "
+                "WHERE device = :device AND bucket >= :start AND bucket < :end" + hour_filter.format(col='bucket')),
+                {'device': device, 'start': sql_ts(range_start), 'end': sql_ts(range_end)}):
+            if sketch:
+                digest.merge(TDigest.from_bytes(sketch))
+            else:
+                digest.add(total / count, count)  # rollup written before sketches existed
+            add_summary(count, total, low, high)
+    if tail < end:
+        # The newest stored minute and anything after it come from the raw rows
+        for (value,) in db.session.execute(text(
+                f"SELECT value FROM distance_reading WHERE timestamp >= :start AND timestamp < :end "
+                f"AND {reading_device_sql()} = :device" + hour_filter.format(col='timestamp')),
+                {'device': device, 'start': sql_ts(tail), 'end': sql_ts(end)}):
+            digest.add(value)
+            add_summary(1, value, value, value)
+
+    result = {'device': device, 'from': to_epoch_ms(start), 'to': to_epoch_ms(end),
+              'hours': hours, 'count': totals['count']}
+    if totals['count']:
+        result.update(mean=round(totals['sum'] / totals['count'], 2),
+                      min=round(totals['min'], 2), max=round(totals['max'], 2))
+        for name, q in STATS_QUANTILES:
+            result[name] = round(min(max(digest.quantile(q), totals['min']), totals['max']), 2)
+    return jsonify(result)
+
+def open_episode_progress(row):
+    """(start, last, min, samples) of an episode open in another process, from its readings so far."""
+    with hot_db() as conn:
+        last, low, samples = conn.execute(
+            f"SELECT MAX(timestamp), MIN(value), COUNT(*) FROM distance_reading "
+            f"WHERE {reading_device_sql()} = ? AND timestamp >= ? AND value < ?",
+            (row.device, sql_ts(row.started_at), EPISODE_THRESHOLD_CM)).fetchone()
+    if not samples:
+        return row.started_at, row.started_at, row.min_value, row.samples
+    return row.started_at, datetime.fromisoformat(last), min(low, row.min_value), samples
+
+def episode_dict(row):
+    """JSON view of an Episode; an open one shows its progress so far."""
+    live = open_episodes.get(row.device)
+    if live is not None and live['id'] == row.id:
+        start, end, low, samples = live['started'], live['last'], live['min'], live['samples']
+        band = SAMPLING_BANDS[sampling_band(low)][1]
+    elif row.ended_at is None:
+        start, end, low, samples = open_episode_progress(row)
+        band = SAMPLING_BANDS[sampling_band(low)][1]
+    else:
+        start, end, low, samples = row.started_at, row.ended_at, row.min_value, row.samples
+        band = row.peak_band
+    return {
+        'id': row.id,
+        'device': row.device,
+        'start': start.isoformat(),
+        'end': row.ended_at.isoformat() if row.ended_at else None,
+        'duration_s': round((end - start).total_seconds(), 1),
+        'min_cm': round(low, 1),
+        'samples': samples,
+        'peak_band': band,
+    }
+
+def episodes_query(start, end, device=None):
+    query = Episode.query.filter(Episode.started_at >= start, Episode.started_at < end)
+    if device:
+        query = query.filter(Episode.device == device)
+    return query
+
+@app.route('/api/episodes')
+def api_episodes():
+    try:
+        end = parse_time_arg(request.args.get('to'), datetime.utcnow())
+        start = parse_time_arg(request.args.get('from'), end - timedelta(days=7))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 0), HISTORY_MAX_PAGE_SIZE)
+    query = episodes_query(start, end, request.args.get('device'))
+    rows = query.order_by(Episode.started_at.desc()).limit(limit).all()
+    return jsonify({
+        'from': to_epoch_ms(start),
+        'to': to_epoch_ms(end),
+        'count': query.count(),
+        'episodes': [episode_dict(row) for row in rows],
+    })
+
+@app.route('/alarm/toggle')
+def toggle_alarm():
+    state = 'on' if set_alarm_enabled() else 'off'
+    mqtt_publish('device/alarm', state)
     return f"Alarm turned {state}"
 
 @app.route('/alarm/state')
 def get_alarm_state():
-    status_obj = PicoStatus.query.first()
-    pico_status = status_obj.status if status_obj else "unknown"
     return jsonify({
         'enabled': alarm_state['enabled'],
-        'pico_status': pico_status
+        'version': alarm_state['version'],
+        'pico_status': current_pico_status()
     })
 
 
+# Alarm history
+#
+# Keyset pagination on (timestamp, id): the "before" cursor names the last row
+# of the previous page, so deep pages cost the same as the first one.
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+def parse_history_cursor(value):
+    if not value:
+        return None
+    ts, _, event_id = value.rpartition('_')
+    return datetime.fromisoformat(ts), int(event_id)
+
+def history_cursor(event):
+    return f"{event.timestamp.isoformat()}_{event.id}"
+
+def alarm_history_query(args):
+    """Filtered, newest-first AlarmEvent query plus the page size, from query args."""
+    limit = min(max(args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    query = AlarmEvent.query
+    if args.get('type'):
+        query = query.filter(AlarmEvent.type == args['type'])
+    since = parse_time_arg(args.get('since'), None)
+    if since is not None:
+        query = query.filter(AlarmEvent.timestamp >= since)
+    until = parse_until_arg(args.get('until'), None)
+    if until is not None:
+        query = query.filter(AlarmEvent.timestamp < until)
+    cursor = parse_history_cursor(args.get('before'))
+    if cursor is not None:
+        ts, event_id = cursor
+        query = query.filter(db.or_(AlarmEvent.timestamp < ts,
+                                    db.and_(AlarmEvent.timestamp == ts, AlarmEvent.id < event_id)))
+    query = query.order_by(AlarmEvent.timestamp.desc(), AlarmEvent.id.desc())
+    return query, limit
+
+class HistoryPage:
+    """Yields one page of events lazily and remembers where the next page starts."""
+
+    def __init__(self, query, limit):
+        self.query = query
+        self.limit = limit
+        self.next = None
+
+    def __iter__(self):
+        last = None
+        for i, event in enumerate(self.query.limit(self.limit + 1).yield_per(100)):
+            if i == self.limit:
+                self.next = history_cursor(last)
+                break
+            last = event
+            yield event
+
+def recent_episodes(args, limit=HISTORY_PAGE_SIZE):
+    """Newest episodes within the history page's date filters, rendered lazily."""
+    start = parse_time_arg(args.get('since'), datetime(1970, 1, 1))
+    end = parse_until_arg(args.get('until'), datetime.utcnow() + timedelta(days=1))
+    rows = episodes_query(start, end).order_by(Episode.started_at.desc()).limit(limit)
+    return (episode_dict(row) for row in rows)
+
+def bad_history_args(error):
+    return jsonify({'error': f'invalid filter: {error}'}), 400
+
+@app.route('/api/alarm-history')
+def alarm_history_api():
+    try:
+        query, limit = alarm_history_query(request.args)
+    except ValueError as e:
+        return bad_history_args(e)
+    page = HistoryPage(query, limit)
+    events = [{
+        'id': e.id,
+        'type': e.type,
+        'detail': e.detail,
+        'timestamp': e.timestamp.isoformat(),
+    } for e in page]
+    return jsonify({'events': events, 'next': page.next})
+
 @app.route('/alarm-history')
 def alarm_history():
-    events = AlarmEvent.query.order_by(AlarmEvent.timestamp.desc()).limit(50).all()
-    return render_template_string('''
+    try:
+        query, limit = alarm_history_query(request.args)
+    except ValueError as e:
+        return bad_history_args(e)
+    page = HistoryPage(query, limit)
+    filters = {k: v for k, v in request.args.items() if k in ('type', 'since', 'until', 'limit') and v}
+    return stream_template(compiled_template('''
         <p>
             <a href="/" style="
                 display: inline-block;
@@ -354,12 +2168,23 @@ def alarm_history():
             ">🏠 Home</a>
         </p>
         <h1>📜 Alarm Event History</h1>
+        <form method="get" style="margin-bottom: 12px;">
+            <select name="type">
+                <option value="">All types</option>
+                {% for t in ['triggered', 'toggled'] %}
+                <option value="{{ t }}" {% if filters.type == t %}selected{% endif %}>{{ t }}</option>
+                {% endfor %}
+            </select>
+            From <input type="date" name="since" value="{{ filters.since or '' }}">
+            To <input type="date" name="until" value="{{ filters.until or '' }}">
+            <button type="submit">Filter</button>
+        </form>
         <table border="1" cellpadding="5">
             <thead>
                 <tr><th>Time</th><th>Type</th><th>Detail</th></tr>
             </thead>
             <tbody>
-                {% for e in events %}
+                {% for e in page %}
                 <tr>
                     <td>{{ e.timestamp.strftime('%Y-%m-%d %H:%M:%S') }}</td>
                     <td>{{ e.type }}</td>
@@ -368,119 +2193,1502 @@ def alarm_history():
                 {% endfor %}
             </tbody>
         </table>
-    ''', events=events)
+        <p>
+            {% if request.args.before %}<a href="{{ url_for('alarm_history', **filters) }}">⏮ Newest</a>{% endif %}
+            {% if page.next %}<a href="{{ url_for('alarm_history', before=page.next, **filters) }}">Older ▶</a>{% endif %}
+        </p>
+        <h2>🚶 Intrusion Episodes</h2>
+        <table border="1" cellpadding="5">
+            <thead>
+                <tr><th>Start</th><th>Duration</th><th>Closest (cm)</th><th>Band</th><th>Readings</th></tr>
+            </thead>
+            <tbody>
+                {% for e in episodes %}
+                <tr>
+                    <td>{{ e.start[:19].replace('T', ' ') }}</td>
+                    <td>{{ e.duration_s }} s{% if not e.end %} (ongoing){% endif %}</td>
+                    <td>{{ e.min_cm }}</td>
+                    <td>{{ e.peak_band }}</td>
+                    <td>{{ e.samples }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    '''), page=page, filters=filters, episodes=recent_episodes(request.args))
 
 @app.route('/pico/status')
 def get_pico_status():
-    status_obj = PicoStatus.query.first()
-    pico_status = status_obj.status if status_obj else "unknown"
-    return jsonify({'status': pico_status})
+    return jsonify({'status': current_pico_status(request.args.get('device', 'pico'))})
+
+@app.route('/migrations')
+def migrations():
+    rows = {m.name: m for m in SchemaMigration.query.all()}
+    result = []
+    for spec in MIGRATIONS:
+        m = rows.get(spec['name'])
+        if m is None:
+            result.append({'name': spec['name'], 'status': 'pending', 'progress': 0.0})
+            continue
+        progress = 1.0 if m.status != 'copying' else (m.last_id / m.max_id if m.max_id else 1.0)
+        result.append({
+            'name': m.name,
+            'status': m.status,
+            'progress': round(progress, 4),
+            'copied': m.copied,
+            'started_at': m.started_at.isoformat() if m.started_at else None,
+            'finished_at': m.finished_at.isoformat() if m.finished_at else None,
+        })
+    return jsonify(result)
+
+def debug_endpoint(view):
+    """Hide a route unless DEBUG_TOKEN is set and the caller presents it."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        expected = app.config['DEBUG_TOKEN']
+        if not expected:
+            abort(404)
+        supplied = request.headers.get('X-Debug-Token') or request.args.get('token', '')
+        if not hmac.compare_digest(supplied.encode(), expected.encode()):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+# Sampling profiler
+PROFILE_MAX_SECONDS = 60
+PROFILE_MAX_HZ = 250
+profile_lock = threading.Lock()
+
+def sample_stacks(seconds, hz, exclude=()):
+    """Sample every thread's Python stack and return {(thread, codes...): count}."""
+    counts = {}
+    skip = {threading.get_ident(), *exclude}
+    names = {}
+    interval = 1.0 / hz
+    deadline = monotonic() + seconds
+    next_names = 0
+    while True:
+        now = monotonic()
+        if now >= deadline:
+            break
+        if now >= next_names:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            next_names = now + 1.0
+        for ident, frame in sys._current_frames().items():
+            if ident in skip:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            key = (names.get(ident, str(ident)), *reversed(codes))
+            counts[key] = counts.get(key, 0) + 1
+        del frame
+        sleep(interval)
+    return counts
+
+def collapse_stacks(counts):
+    """Render sampled stacks in the collapsed format used by flamegraph.pl/speedscope."""
+    labels = {}
+    lines = []
+    for key, count in counts.items():
+        parts = [key[0].replace(' ', '_')]
+        for code in key[1:]:
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f"{code.co_name}({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            parts.append(label)
+        lines.append(f"{';'.join(parts)} {count}")
+    lines.sort()
+    return '\n'.join(lines) + '\n'
+
+@app.route('/debug/profile')
+@debug_endpoint
+def debug_profile():
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILE_MAX_SECONDS)
+    hz = min(max(request.args.get('hz', 100, type=int), 1), PROFILE_MAX_HZ)
+    if not profile_lock.acquire(blocking=False):
+        return "A profile is already running", 409
+    try:
+        result = {}
+        requester = threading.get_ident()
+        sampler = threading.Thread(target=lambda: result.update(sample_stacks(seconds, hz, exclude=(requester,))),
+                                   name='profiler', daemon=True)
+        sampler.start()
+        sampler.join()
+    finally:
+        profile_lock.release()
+    return Response(collapse_stacks(result), mimetype='text/plain')
+
+# Heap diagnostics
+HEAP_MAX_SNAPSHOTS = 5
+heap_snapshots = OrderedDict()
+
+MEMORY_GAUGE_INTERVAL = 60  # seconds
+memory_stats = deque(maxlen=24 * 60)  # one day at the default interval
+
+def read_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def sample_memory():
+    sample = {
+        'time': datetime.utcnow().isoformat(timespec='seconds'),
+        'rss_kb': read_rss_kb(),
+        'gc_counts': gc.get_count(),
+        'gc_collections': [s['collections'] for s in gc.get_stats()],
+        'gc_uncollectable': sum(s['uncollectable'] for s in gc.get_stats()),
+        'threads': threading.active_count(),
+    }
+    if tracemalloc.is_tracing():
+        sample['traced_kb'] = tracemalloc.get_traced_memory()[0] // 1024
+    memory_stats.append(sample)
+    return sample
+
+def memory_gauge_loop():
+    while True:
+        sample_memory()
+        sleep(MEMORY_GAUGE_INTERVAL)
+
+@app.route('/debug/memory')
+@debug_endpoint
+def debug_memory():
+    current = sample_memory()
+    samples = list(memory_stats)
+    return jsonify({
+        'current': current,
+        'rss_growth_kb': current['rss_kb'] - samples[0]['rss_kb'],
+        'samples': samples,
+    })
+
+@app.route('/debug/heap/start')
+@debug_endpoint
+def debug_heap_start():
+    frames = min(max(request.args.get('frames', 1, type=int), 1), 25)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return jsonify({'tracing': True, 'frames': tracemalloc.get_traceback_limit()})
+
+@app.route('/debug/heap/stop')
+@debug_endpoint
+def debug_heap_stop():
+    tracemalloc.stop()
+    heap_snapshots.clear()
+    return jsonify({'tracing': False})
+
+@app.route('/debug/heap/snapshot/<name>')
+@debug_endpoint
+def debug_heap_snapshot(name):
+    if not tracemalloc.is_tracing():
+        return jsonify({'error': 'tracemalloc is not running, call /debug/heap/start first'}), 409
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    heap_snapshots.pop(name, None)
+    heap_snapshots[name] = snapshot
+    while len(heap_snapshots) > HEAP_MAX_SNAPSHOTS:
+        heap_snapshots.popitem(last=False)
+    current, peak = tracemalloc.get_traced_memory()
+    return jsonify({'name': name, 'snapshots': list(heap_snapshots), 'traced_kb': current // 1024, 'peak_kb': peak // 1024})
+
+@app.route('/debug/heap/diff')
+@debug_endpoint
+def debug_heap_diff():
+    old, new = heap_snapshots.get(request.args.get('from')), heap_snapshots.get(request.args.get('to'))
+    if old is None or new is None:
+        return jsonify({'error': 'unknown snapshot', 'snapshots': list(heap_snapshots)}), 404
+    limit = min(max(request.args.get('limit', 25, type=int), 1), 500)
+    stats = new.compare_to(old, 'lineno')[:limit]
+    return jsonify([{
+        'where': f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+        'size_diff_kb': round(s.size_diff / 1024, 1),
+        'count_diff': s.count_diff,
+        'size_kb': round(s.size / 1024, 1),
+        'count': s.count,
+    } for s in stats])
+
+# Per-message latency tracing
+TRACE_BUFFER_SIZE = 500
+TRACE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+completed_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+trace_ids = itertools.count(1)
+current_trace = threading.local()
+
+class Trace:
+    """Monotonic stage timestamps for one MQTT message, relative to receipt."""
+    __slots__ = ('id', 'topic', 'received_at', 'start', 'stages')
+
+    def __init__(self, topic):
+        self.id = next(trace_ids)
+        self.topic = topic
+        self.received_at = time()
+        self.start = monotonic()
+        self.stages = [('received', 0.0)]
+
+    def mark(self, stage):
+        self.stages.append((stage, monotonic() - self.start))
+
+    def total(self):
+        return self.stages[-1][1]
+
+def start_trace(topic):
+    trace = Trace(topic)
+    current_trace.trace = trace
+    return trace
+
+def finish_trace(trace):
+    current_trace.trace = None
+    completed_traces.append(trace)
+
+def trace_mark(stage):
+    trace = getattr(current_trace, 'trace', None)
+    if trace is not None:
+        trace.mark(stage)
+
+@app.route('/debug/traces')
+@debug_endpoint
+def debug_traces():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), TRACE_BUFFER_SIZE)
+    topic = request.args.get('topic')
+    traces = [t for t in list(completed_traces) if topic is None or t.topic == topic]
+
+    # Time spent reaching each stage from the previous one, counted per bucket
+    histograms = {}
+    for t in traces:
+        previous = 0.0
+        for stage, offset in t.stages[1:]:
+            elapsed_ms = (offset - previous) * 1000
+            previous = offset
+            buckets = histograms.setdefault(stage, [0] * (len(TRACE_BUCKETS_MS) + 1))
+            buckets[bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+    labels = [f"<={b}ms" for b in TRACE_BUCKETS_MS] + [f">{TRACE_BUCKETS_MS[-1]}ms"]
+
+    slowest = sorted(traces, key=Trace.total, reverse=True)[:limit]
+    return jsonify({
+        'count': len(traces),
+        'slowest': [{
+            'id': t.id,
+            'topic': t.topic,
+            'received_at': datetime.utcfromtimestamp(t.received_at).isoformat(timespec='milliseconds'),
+            'total_ms': round(t.total() * 1000, 3),
+            'stages': [{'stage': name, 'at_ms': round(offset * 1000, 3)} for name, offset in t.stages],
+        } for t in slowest],
+        'histogram_buckets': labels,
+        'stage_histograms': histograms,
+    })
+
+# Online backups
+#
+# SQLite's backup API copies BACKUP_PAGES_PER_STEP pages at a time and sleeps
+# in between. The source connection holds a read transaction for the whole
+# copy, so in WAL mode every step sees the same snapshot: commits by the
+# ingest process neither block the copy nor force it to restart, and the
+# backup never takes the write lock.
+BACKUP_DIR = os.path.join(app.instance_path, 'backups')
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL_HOURS', '24')) * 3600
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', '7'))  # checked in main(), so importing never exits
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.05  # seconds
+backup_lock = threading.Lock()
+backup_state = {'running': False, 'last': None, 'last_error': None}
+
+def list_backups():
+    try:
+        names = sorted(n for n in os.listdir(BACKUP_DIR) if n.endswith('.db.gz'))
+    except FileNotFoundError:
+        return []
+    return [{'file': n, 'bytes': os.path.getsize(os.path.join(BACKUP_DIR, n))} for n in names]
+
+def run_backup():
+    """Snapshot distances.db into BACKUP_DIR as a gzip file and prune old ones."""
+    if not backup_lock.acquire(blocking=False):
+        return None
+    backup_state['running'] = True
+    started = monotonic()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"distances-{datetime.utcnow():%Y%m%d-%H%M%S}.db"
+    path = os.path.join(BACKUP_DIR, name)
+    progress = {'pages': 0}
+
+    def step_done(status, remaining, total):
+        progress['pages'] = total
+        if remaining:
+            sleep(BACKUP_STEP_PAUSE)  # backup()'s own sleep only applies while the source is busy
+    src = open_raw_db()
+    try:
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()  # pins the snapshot
+        dst = sqlite3.connect(path + '.tmp')
+        try:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=step_done)
+        finally:
+            dst.close()
+        src.execute('COMMIT')
+        with open(path + '.tmp', 'rb') as raw, gzip.open(path + '.gz.tmp', 'wb') as packed:
+            shutil.copyfileobj(raw, packed, 1024 * 1024)
+        os.replace(path + '.gz.tmp', path + '.gz')
+        result = {
+            'file': name + '.gz',
+            'finished_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'duration_s': round(monotonic() - started, 2),
+            'pages': progress['pages'],
+            'bytes': os.path.getsize(path + '.tmp'),
+            'compressed_bytes': os.path.getsize(path + '.gz'),
+        }
+        backups = list_backups()
+        for old in backups[:max(len(backups) - BACKUP_KEEP, 0)]:
+            os.remove(os.path.join(BACKUP_DIR, old['file']))
+        backup_state.update(last=result, last_error=None)
+        print(f"💾 Backup {result['file']}: {result['pages']} pages in {result['duration_s']}s")
+        return result
+    except Exception as e:
+        backup_state['last_error'] = str(e)
+        print(f"❌ Backup failed: {e}")
+        return None
+    finally:
+        src.close()
+        for leftover in (path + '.tmp', path + '.gz.tmp'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        backup_state['running'] = False
+        backup_lock.release()
+
+def backup_loop():
+    while True:
+        sleep(BACKUP_INTERVAL)
+        run_backup()
+
+@app.route('/debug/backup')
+@debug_endpoint
+def debug_backup():
+    return jsonify({**backup_state, 'interval_hours': BACKUP_INTERVAL / 3600, 'keep': BACKUP_KEEP,
+                    'backups': list_backups()})
+
+@app.route('/debug/backup/start')
+@debug_endpoint
+def debug_backup_start():
+    if backup_state['running']:
+        return jsonify({'error': 'a backup is already running'}), 409
+    threading.Thread(target=run_backup, daemon=True).start()
+    return jsonify({'started': True}), 202
+
+# Device liveness
+#
+# Status messages, the Pico's last will and every reading feed an in-memory
+# tracker. Silence longer than LIVENESS_TIMEOUT counts as offline, and a new
+# state has to hold for LIVENESS_DEBOUNCE seconds before it is persisted,
+# broadcast and notified, so flaps shorter than that never leave memory.
+LIVENESS_TIMEOUT = float(os.environ.get('LIVENESS_TIMEOUT', '30'))  # seconds
+LIVENESS_DEBOUNCE = 10  # seconds
+STATUS_MESSAGES = {
+    'online': "📶 Pico W is now online and connected.",
+    'offline': "🔌 Pico W is offline or disconnected.",
+}
+
+class TimerWheel:
+    """Hashed timing wheel with one-second ticks; one pending deadline per key."""
+
+    def __init__(self, slots=64):
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.tick = int(monotonic())
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        self.slots[int(deadline) % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """Return the keys whose deadline has passed, processing whole ticks only."""
+        expired = []
+        while self.tick < int(now):
+            index = self.tick % len(self.slots)
+            slot = self.slots[index]
+            for key in list(slot):
+                deadline = self.deadlines.get(key)
+                if deadline is None or int(deadline) % len(self.slots) != index:
+                    slot.discard(key)  # cancelled or rescheduled into another slot
+                elif deadline <= now:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+            self.tick += 1
+        return expired
+
+liveness_lock = threading.Lock()
+liveness_wheel = TimerWheel()
+liveness = {}  # device -> {'reported', 'observed', 'trace'}
+
+def observe_liveness(device, state):
+    now = monotonic()
+    with liveness_lock:
+        entry = liveness.get(device)
+        if entry is None:
+            reported = current_pico_status(device)
+            entry = liveness[device] = {'reported': reported, 'observed': reported, 'trace': None}
+        if state == 'online':
+            liveness_wheel.schedule(('silence', device), now + LIVENESS_TIMEOUT)
+        else:
+            liveness_wheel.cancel(('silence', device))
+        if state == entry['observed']:
+            return
+        entry['observed'] = state
+        if state == entry['reported']:
+            liveness_wheel.cancel(('debounce', device))  # flapped back before it counted
+            entry['trace'] = None
+        else:
+            liveness_wheel.schedule(('debounce', device), now + LIVENESS_DEBOUNCE)
+            entry['trace'] = getattr(current_trace, 'trace', None)
+
+def liveness_tick():
+    sweep_episodes()
+    sweep_rollups(rollup_bucket(datetime.utcnow()))
+    transitions = []
+    now = monotonic()
+    with liveness_lock:
+        for kind, device in liveness_wheel.advance(now):
+            entry = liveness[device]
+            if kind == 'silence' and entry['observed'] != 'offline':
+                print(f"🔇 No data from {device} for {LIVENESS_TIMEOUT:g}s")
+                entry['observed'] = 'offline'
+                if entry['reported'] != 'offline':
+                    liveness_wheel.schedule(('debounce', device), now + LIVENESS_DEBOUNCE)
+            elif kind == 'debounce' and entry['observed'] != entry['reported']:
+                entry['reported'] = entry['observed']
+                transitions.append((device, entry['reported'], entry['trace']))
+                entry['trace'] = None
+    for device, state, trace in transitions:
+        print(f"📡 {device} is now {state}")
+        set_pico_status(state, device)
+        bus_publish('status', device=device, status=state)
+        if trace is not None:
+            trace.mark('persisted')
+        current_trace.trace = trace
+        try:
+            notify(state, STATUS_MESSAGES[state], device)
+        finally:
+            current_trace.trace = None
+
+def seed_liveness():
+    """Track every device stored as online from startup: one that never sends
+    again still goes offline LIVENESS_TIMEOUT after its last reading or status."""
+    now, utcnow = monotonic(), datetime.utcnow()
+    device_sql = reading_device_sql()
+    with hot_db() as conn:
+        online = conn.execute("SELECT device, MAX(timestamp) FROM pico_status WHERE status = 'online' "
+                              "GROUP BY device").fetchall()
+        for device, status_at in online:
+            last = conn.execute(f"SELECT timestamp FROM distance_reading WHERE {device_sql} = ? "
+                                "ORDER BY timestamp DESC LIMIT 1", (device,)).fetchone()
+            seen = max((datetime.fromisoformat(ts) for ts in (status_at, last and last[0]) if ts), default=datetime.min)
+            with liveness_lock:
+                liveness.setdefault(device, {'reported': 'online', 'observed': 'online', 'trace': None})
+                liveness_wheel.schedule(('silence', device),
+                                        now + max(LIVENESS_TIMEOUT - (utcnow - seen).total_seconds(), 0))
+
+def liveness_loop():
+    while True:
+        sleep(1)
+        try:
+            liveness_tick()
+        except Exception as e:
+            print(f"❌ Liveness tracker failed: {e}")
+
+# Proximity-adaptive sampling
+#
+# Each device is told how often to sample on its own SAMPLING_TOPIC (retained,
+# so it gets its current rate when it reconnects, and never another device's).
+# Speeding up is immediate; slowing down needs the reading to clear the band
+# boundary by SAMPLING_HYSTERESIS_CM for SAMPLING_SLOWDOWN_HOLD seconds and a
+# command from the per-device budget.
+SAMPLING_TOPIC = 'device/{device}/config/sampling'
+SAMPLING_BANDS = [  # (upper bound in cm, band, sampling interval in ms), closest first
+    (20, 'danger', 100),
+    (50, 'close', 200),
+    (100, 'near', 500),
+    (None, 'safe', 2000),
+]
+SAMPLING_HYSTERESIS_CM = 10
+SAMPLING_SLOWDOWN_HOLD = 30  # seconds
+SAMPLING_BUDGET = 6  # commands per device per minute
+sampling_state = {}
+
+def sampling_band(cm, current=None):
+    """Index into SAMPLING_BANDS for a reading; None means nothing in range."""
+    target = len(SAMPLING_BANDS) - 1
+    if cm is not None:
+        for index, (limit, _, _) in enumerate(SAMPLING_BANDS):
+            if limit is None or cm < limit:
+                target = index
+                break
+    if current is not None and target > current and cm is not None:
+        if cm < SAMPLING_BANDS[current][0] + SAMPLING_HYSTERESIS_CM:
+            return current
+    return target
+
+def update_sampling(device, cm):
+    if not device or any(c in device for c in '/+#'):
+        return  # no topic of its own to send a rate to
+    now = monotonic()
+    state = sampling_state.get(device)
+    if state is None:
+        state = sampling_state[device] = {'band': None, 'slower_since': None,
+                                          'tokens': float(SAMPLING_BUDGET), 'refilled': now}
+    state['tokens'] = min(SAMPLING_BUDGET, state['tokens'] + (now - state['refilled']) * SAMPLING_BUDGET / 60)
+    state['refilled'] = now
+
+    target = sampling_band(cm, state['band'])
+    if target == state['band']:
+        state['slower_since'] = None
+        return
+    if state['band'] is not None and target > state['band']:
+        if state['slower_since'] is None:
+            state['slower_since'] = now
+        if now - state['slower_since'] < SAMPLING_SLOWDOWN_HOLD or state['tokens'] < 1:
+            return
+    # Speed-ups are never held back by the budget; they only delay the next slow-down.
+    state['tokens'] -= 1
+    state['band'] = target
+    state['slower_since'] = None
+    _, band, interval = SAMPLING_BANDS[target]
+    mqtt.publish(SAMPLING_TOPIC.format(device=device), json.dumps({'device': device, 'band': band, 'interval_ms': interval}),
+                 qos=1, retain=True)
+    print(f"🎚️ Sampling for {device}: {band} band, every {interval} ms")
+
+# Notification outbox
+#
+# Notifications are rows written in the same transaction as the event that
+# caused them, one per channel. Every channel has its own queue: a background
+# sender drains them concurrently on a small thread pool, oldest first, and a
+# channel that is slow or unreachable backs off on its own without holding up
+# the others. A backlog is sent as one combined message.
+OUTBOX_TTL = timedelta(hours=6)
+OUTBOX_POLL_INTERVAL = 5  # seconds
+OUTBOX_BACKOFF_BASE = 5  # seconds, doubled per failed attempt
+OUTBOX_BACKOFF_MAX = 600
+OUTBOX_BATCH = 20
+OUTBOX_WORKERS = 4  # channels sending at the same time
+DIGEST_MAX_LENGTH = 1024  # Pushover's limit, used for every channel
+CHANNEL_LATENCY_SAMPLES = 100
+outbox_wakeup = threading.Event()
+outbox_traces = {}  # outbox id -> Trace waiting for its 'notification_sent' stage
+outbox_pool = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix='notify')
+outbox_busy = set()  # channels with a drain running
+outbox_busy_lock = threading.Lock()
+channel_stats = {}  # channel -> counters and recent send latencies
+
+# Notification channels
+#
+# A channel is a function send(message, timeout) registered with @notifier.
+# It returns once the message is delivered, raises NotifyRejected when
+# retrying cannot help (the rows are marked failed) and anything else to be
+# retried with backoff. NOTIFY_CHANNELS picks which registered channels run.
+NOTIFIERS = {}
+
+class NotifyRejected(Exception):
+    """The channel refused the message; retrying will not help."""
+
+def notifier(name, timeout, categories=None, requires=None):
+    """Register a channel; `categories` limits what it receives, `requires` names a config key it needs."""
+    def register(send):
+        NOTIFIERS[name] = {'send': send, 'timeout': timeout, 'categories': categories, 'requires': requires}
+        return send
+    return register
+
+def notify_channels(category=None):
+    """Configured channels (taking `category`, if given), in NOTIFY_CHANNELS order."""
+    names = [name.strip() for name in app.config['NOTIFY_CHANNELS'].split(',') if name.strip()]
+    usable = []
+    for name in names:
+        channel = NOTIFIERS.get(name)
+        if channel is None or (channel['requires'] and not app.config[channel['requires']]):
+            continue
+        if category is None or channel['categories'] is None or category in channel['categories']:
+            usable.append(name)
+    return usable
+
+def post_http(url, body, headers, timeout):
+    """POST and read the response; NotifyRejected on 4xx (except 429), OSError on other failures."""
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = connection(parts.netloc, timeout=timeout)
+    try:
+        conn.request("POST", parts.path + (f"?{parts.query}" if parts.query else ''), body, headers)
+        response = conn.getresponse()
+        response.read()
+    finally:
+        conn.close()
+    if 200 <= response.status < 300:
+        return
+    if 400 <= response.status < 500 and response.status != 429:
+        raise NotifyRejected(f"HTTP {response.status}")
+    raise OSError(f"HTTP {response.status}")
+
+@notifier('pushover', timeout=10)
+def send_pushover(message, timeout):
+    post_http(app.config['PUSHOVER_URL'],
+              urllib.parse.urlencode({
+                  "token": app.config['PUSHOVER_TOKEN'],
+                  "user": app.config['PUSHOVER_USER'],
+                  "message": message,
+              }), { "Content-type": "application/x-www-form-urlencoded" }, timeout)
+
+@notifier('webhook', timeout=5, requires='WEBHOOK_URL')
+def send_webhook(message, timeout):
+    body = json.dumps({'site': app.config['SITE_ID'], 'message': message, 'sent_at': datetime.utcnow().isoformat()})
+    post_http(app.config['WEBHOOK_URL'], body, {'Content-Type': 'application/json'}, timeout)
+
+@notifier('siren', timeout=3, categories=('trigger',))
+def send_siren(message, timeout):
+    info = mqtt.client.publish(app.config['SIREN_TOPIC'], json.dumps({'state': 'on', 'message': message}), qos=1)
+    info.wait_for_publish(timeout)  # raises when the client is not connected
+    if not info.is_published():
+        raise TimeoutError(f"not acknowledged within {timeout}s")
+
+@notifier('logfile', timeout=1)
+def send_logfile(message, timeout):
+    path = app.config['NOTIFY_LOG'] or os.path.join(app.instance_path, 'notifications.log')
+    indented = message.replace('\n', '\n    ')  # digests span several lines
+    with open(path, 'a') as f:
+        f.write(f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} {indented}\n")
+
+if INGEST:
+    skipped = set(app.config['NOTIFY_CHANNELS'].replace(' ', '').split(',')) - set(notify_channels()) - {''}
+    for name in sorted(skipped):
+        print(f"⚠️ Notification channel {name!r} is unknown or not configured; skipping it.")
+
+def enqueue_notification(category, message):
+    """Add one row per channel taking `category` to the current session; sent once the caller commits."""
+    now = datetime.utcnow()
+    rows = [NotificationOutbox(channel=name, category=category, message=message, created_at=now,
+                               next_attempt_at=now, expires_at=now + OUTBOX_TTL)
+            for name in notify_channels(category)]
+    db.session.add_all(rows)
+    return rows
+
+def notify(category, message, device='pico'):
+    if not allow_notification(category, device):
+        print(f"⏳ Holding {category} notification for the next digest")
+        return
+    with app.app_context():
+        rows = enqueue_notification(category, message)
+        db.session.commit()
+        queued(rows)
+
+def queued(rows):
+    trace = getattr(current_trace, 'trace', None)
+    if trace is not None:
+        trace.mark('notification_queued')
+        for row in rows:
+            outbox_traces[row.id] = trace
+    outbox_wakeup.set()
+
+def digest_message(rows):
+    """Combine a backlog into one message; returns (message, rows included)."""
+    if len(rows) == 1:
+        return rows[0].message, rows
+    lines, included = [], []
+    header = "📬 {} notifications while offline:"
+    for row in rows:
+        line = f"{row.created_at:%H:%M} {row.message}"
+        if len('\n'.join([header.format(len(included) + 1), *lines, line])) > DIGEST_MAX_LENGTH:
+            break
+        lines.append(line)
+        included.append(row)
+    return '\n'.join([header.format(len(included)), *lines]), included
+
+def drain_outbox():
+    """Start a drain for every channel that is not still busy with its previous one."""
+    for name in notify_channels():
+        with outbox_busy_lock:
+            if name in outbox_busy:
+                continue
+            outbox_busy.add(name)
+        outbox_pool.submit(_drain_channel_task, name)
+
+def _drain_channel_task(name):
+    sent = 0
+    try:
+        sent = drain_channel(name)
+    except Exception as e:
+        print(f"❌ Notification channel {name} failed: {e}")
+    finally:
+        with outbox_busy_lock:
+            outbox_busy.discard(name)
+    if sent:
+        outbox_wakeup.set()  # anything queued while this drain was finishing
+
+def drain_channel(name):
+    """Send a channel's pending notifications in order until its queue is empty or sending fails."""
+    channel = NOTIFIERS[name]
+    stats = channel_stats.setdefault(name, {'sent': 0, 'messages': 0, 'failed_attempts': 0, 'rejected': 0,
+                                            'latencies': deque(maxlen=CHANNEL_LATENCY_SAMPLES)})
+    sent = 0
+    with app.app_context():
+        while True:
+            now = datetime.utcnow()
+            expired = NotificationOutbox.query.filter(NotificationOutbox.status == 'pending',
+                                                      NotificationOutbox.channel == name,
+                                                      NotificationOutbox.expires_at < now).all()
+            for row in expired:
+                row.status = 'expired'
+                outbox_traces.pop(row.id, None)
+                print(f"⌛ Dropping expired {name} notification: {row.message}")
+            db.session.commit()
+
+            pending = (NotificationOutbox.query.filter_by(status='pending', channel=name)
+                       .order_by(NotificationOutbox.id).limit(OUTBOX_BATCH).all())
+            if not pending or pending[0].next_attempt_at > now:
+                return sent
+            message, rows = digest_message(pending)
+            started = monotonic()
+            try:
+                channel['send'](message, channel['timeout'])
+                error, rejected = None, False
+            except NotifyRejected as e:
+                error, rejected = str(e), True
+            except Exception as e:
+                error, rejected = str(e) or type(e).__name__, False
+
+            if error is None:
+                stats['latencies'].append(monotonic() - started)
+                for row in rows:
+                    row.status, row.sent_at, row.attempts = 'sent', now, row.attempts + 1
+                    trace = outbox_traces.pop(row.id, None)
+                    if trace is not None and 'notification_sent' not in (stage for stage, _ in trace.stages):
+                        trace.mark('notification_sent')  # by whichever channel delivers first
+                db.session.commit()
+                stats['sent'] += len(rows)
+                stats['messages'] += 1
+                sent += len(rows)
+                print(f"✅ {name}: sent {len(rows)} notification(s).")
+                continue
+
+            stats['failed_attempts'] += 1
+            if rejected:
+                for row in rows:
+                    row.status, row.last_error = 'failed', error
+                    outbox_traces.pop(row.id, None)
+                stats['rejected'] += len(rows)
+                db.session.commit()
+                print(f"❌ {name} rejected notification(s): {error}")
+                continue
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** pending[0].attempts)
+            for row in rows:
+                row.attempts += 1
+                row.last_error = error[:200]
+                row.next_attempt_at = now + timedelta(seconds=delay)
+            db.session.commit()
+            print(f"❌ Error sending {name} message ({error}); retrying in {delay}s")
+            return sent
+
+# Notification policy
+#
+# Each (category, device) pair has a token bucket. Notifications over the limit
+# are held per device and summarised in one digest NOTIFY_DIGEST_WINDOW seconds
+# after the first one was held. The digest counts everything that happened
+# from one window before that point, sent or held, so the burst that used up
+# the tokens is part of the count.
+NOTIFY_POLICY = {  # category -> (burst, seconds to earn one more notification)
+    'trigger': (1, PUSHOVER_COOLDOWN),
+    'online': (2, 300),
+    'offline': (2, 300),
+}
+NOTIFY_DIGEST_WINDOW = 300  # seconds
+notify_lock = threading.Lock()
+notify_buckets = {}
+notify_held = {}  # device -> monotonic time its first held notification arrived
+notify_recent = {}  # device -> deque of (monotonic time, category, cm), sent or held
+notify_stats = {}
+
+def allow_notification(category, device, cm=None):
+    """Take a token for (category, device); otherwise hold the event for the digest."""
+    burst, refill = NOTIFY_POLICY[category]
+    now = monotonic()
+    with notify_lock:
+        recent = notify_recent.setdefault(device, deque())
+        recent.append((now, category, cm))
+        while recent[0][0] < now - 2 * NOTIFY_DIGEST_WINDOW:
+            recent.popleft()  # older than any digest can reach back
+        stats = notify_stats.setdefault(category, {'sent': 0, 'suppressed': 0})
+        bucket = notify_buckets.get((category, device))
+        if bucket is None:
+            bucket = notify_buckets[(category, device)] = {'tokens': float(burst), 'updated': now}
+        bucket['tokens'] = min(burst, bucket['tokens'] + (now - bucket['updated']) / refill)
+        bucket['updated'] = now
+        if bucket['tokens'] >= 1:
+            bucket['tokens'] -= 1
+            stats['sent'] += 1
+            return True
+        stats['suppressed'] += 1
+        notify_held.setdefault(device, now)
+        return False
+
+def plural(count, word, words=None):
+    return f"{count} {word if count == 1 else words or word + 's'}"
+
+def digest_text(device, events):
+    """Summary of a device's (time, category, cm) events, oldest first; the minutes span first to last."""
+    minutes = max(1, round((events[-1][0] - events[0][0]) / 60))
+    flaps = sum(1 for _, category, _ in events if category in ('online', 'offline'))
+    approaches = [cm for _, category, cm in events if category == 'trigger']
+    parts = []
+    if flaps:
+        parts.append(f"{device.capitalize()} flapped {plural(flaps, 'time')} in {minutes} min")
+    if approaches:
+        summary = plural(len(approaches), 'close approach', 'close approaches')
+        if not flaps:
+            summary += f" in {minutes} min"
+        closest = min((cm for cm in approaches if cm is not None), default=None)
+        parts.append(summary if closest is None else f"{summary}, min {closest:.1f} cm")
+    status = [category for _, category, _ in events if category in ('online', 'offline')]
+    if status:
+        parts.append(f"now {status[-1]}")
+    return "📋 " + '; '.join(parts)
+
+def flush_digests(force=False):
+    now = monotonic()
+    with notify_lock:
+        due = [device for device, since in notify_held.items()
+               if force or now - since >= NOTIFY_DIGEST_WINDOW]
+        digests = []
+        for device in due:
+            since = notify_held.pop(device)
+            events = [event for event in notify_recent.get(device, ())
+                      if event[0] >= since - NOTIFY_DIGEST_WINDOW]
+            digests.append((device, events))
+    for device, events in digests:
+        message = digest_text(device, events)
+        with app.app_context():
+            enqueue_notification('digest', message)
+            db.session.commit()
+        stats = notify_stats.setdefault('digest', {'sent': 0, 'suppressed': 0})
+        stats['sent'] += 1
+        print(f"📋 Queued digest for {device}: {message}")
+        outbox_wakeup.set()
+
+def outbox_sender_loop():
+    while True:
+        try:
+            flush_digests()
+            drain_outbox()
+        except Exception as e:
+            print(f"❌ Notification sender failed: {e}")
+        outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        outbox_wakeup.clear()
+
+def outbox_depth():
+    with app.app_context():
+        rows = (db.session.query(NotificationOutbox.channel, db.func.count(NotificationOutbox.id),
+                                 db.func.min(NotificationOutbox.created_at))
+                .filter_by(status='pending').group_by(NotificationOutbox.channel).all())
+    now = datetime.utcnow()
+    pending = {channel: (count, datetime.fromisoformat(oldest) if isinstance(oldest, str) else oldest)
+               for channel, count, oldest in rows}
+    channels = {}
+    for name in dict.fromkeys([*notify_channels(), *channel_stats, *pending]):
+        stats = channel_stats.get(name, {})
+        latencies = sorted(stats.get('latencies', ()))
+        count, oldest = pending.get(name, (0, None))
+        channels[name] = {
+            'pending': count,
+            'oldest_pending_s': round((now - oldest).total_seconds(), 1) if oldest else None,
+            **{key: stats.get(key, 0) for key in ('sent', 'messages', 'failed_attempts', 'rejected')},
+            'latency_ms': {
+                'last': round(stats['latencies'][-1] * 1000, 1),
+                'avg': round(sum(latencies) / len(latencies) * 1000, 1),
+                'p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+            } if latencies else None,
+        }
+    oldest = min((oldest for _, oldest in pending.values() if oldest), default=None)
+    return {
+        'pending': sum(count for count, _ in pending.values()),
+        'oldest_pending_s': round((now - oldest).total_seconds(), 1) if oldest else None,
+        **{key: sum(c[key] for c in channels.values()) for key in ('sent', 'messages', 'failed_attempts', 'rejected')},
+        'channels': channels,
+    }
+
+# Distance payloads
+#
+# Besides the legacy bare float (metres, timestamped on receipt) the Pico can
+# send batches of samples stamped with its own clock:
+#   JSON:   {"device": "pico", "seq": 42, "samples": [[epoch_ms, metres], ...]}
+#   binary: b'PZD1', uint8 device id length, device id, uint32 seq, uint16 count,
+#           int64 epoch_ms of the first sample, then count x (uint32 ms offset,
+#           float32 metres), all little-endian
+# 'seq' numbers samples, so a batch covers seq .. seq + count - 1.
+DISTANCE_BATCH_MAGIC = b'PZD1'
+DISTANCE_BATCH_HEADER = struct.Struct('<IHq')
+DISTANCE_BATCH_SAMPLE = struct.Struct('<If')
+DEVICE_CLOCK_TOLERANCE = 86400  # seconds; beyond this the Pico clock is assumed unset
+SEQUENCE_RESET_GAP = 10000  # a sequence this far behind means the Pico restarted
+sequence_state = {}
+
+def decode_distance_payload(raw, received):
+    """Return (device, seq, [(timestamp, metres), ...]) for any supported payload."""
+    if raw[:4] == DISTANCE_BATCH_MAGIC:
+        id_end = 5 + raw[4]
+        device = raw[5:id_end].decode()
+        seq, count, first_ms = DISTANCE_BATCH_HEADER.unpack_from(raw, id_end)
+        body = raw[id_end + DISTANCE_BATCH_HEADER.size:]
+        if len(body) < count * DISTANCE_BATCH_SAMPLE.size:
+            raise ValueError(f"truncated batch: {count} samples announced, {len(body)} bytes")
+        samples = [(first_ms + offset, round(metres, 4))
+                   for offset, metres in DISTANCE_BATCH_SAMPLE.iter_unpack(body[:count * DISTANCE_BATCH_SAMPLE.size])]
+    elif raw[:1] == b'{':
+        data = json.loads(raw)
+        device, seq = str(data.get('device', 'pico')), data.get('seq')
+        samples = [(int(t), float(metres)) for t, metres in data['samples']]
+    else:
+        return 'pico', None, [(received, float(raw.decode()))]
+    if samples:
+        # An unset Pico clock keeps its sample spacing but is anchored at receipt
+        skew = to_epoch_ms(received) - samples[-1][0]
+        if abs(skew) > DEVICE_CLOCK_TOLERANCE * 1000:
+            samples = [(t + skew, metres) for t, metres in samples]
+    epoch = datetime(1970, 1, 1)
+    return device, seq, [(epoch + timedelta(milliseconds=t), metres) for t, metres in samples]
+
+def check_sequence(device, seq, count):
+    """Track gaps and out-of-order batches; returns False for a duplicate batch."""
+    if seq is None:
+        return True
+    state = sequence_state.get(device)
+    if state is None:
+        state = sequence_state[device] = {'next': None, 'batches': 0, 'gaps': 0, 'missing': 0,
+                                          'out_of_order': 0, 'duplicates': 0, 'resets': 0,
+                                          'recent': deque(maxlen=64)}
+    if (seq, count) in state['recent']:
+        state['duplicates'] += 1
+        return False
+    state['recent'].append((seq, count))
+    state['batches'] += 1
+    expected = state['next']
+    if expected is None or seq == expected:
+        state['next'] = seq + count
+    elif seq > expected:
+        state['gaps'] += 1
+        state['missing'] += seq - expected
+        state['next'] = seq + count
+        print(f"⚠️ {device}: {seq - expected} samples missing before seq {seq}")
+    elif seq == 0 or expected - seq > SEQUENCE_RESET_GAP:
+        state['resets'] += 1
+        state['next'] = seq + count
+        print(f"🔄 {device}: sequence restarted at {seq}")
+    else:
+        state['out_of_order'] += 1
+        print(f"⚠️ {device}: batch {seq} arrived out of order (expected {expected})")
+    return True
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        'sequence': {device: {k: v for k, v in state.items() if k != 'recent'}
+                     for device, state in sequence_state.items()},
+        'outbox': outbox_depth(),
+        'notifications': notify_stats,
+        'forwarding': forward_stats if app.config['FORWARD_URL'] else None,
+        'startup': {
+            'phases': [{'phase': name, 'seconds': round(seconds, 3)} for name, seconds in startup['phases']],
+            'ready_after': startup['ready_after'] and round(startup['ready_after'], 3),
+            'background': {name: round(seconds, 3) for name, seconds in startup['background'].items()},
+        },
+    })
+
+# Upstream forwarding
+#
+# Tails distance_reading and alarm_event by id and POSTs gzipped JSON batches
+# to FORWARD_URL, keeping up to FORWARD_MAX_IN_FLIGHT requests outstanding.
+# The cursor in ForwardCursor only moves past a batch once it and every batch
+# before it were acknowledged. After a failure everything from the cursor is
+# sent again, and the aggregator drops the duplicates by (site, device, seq).
+FORWARD_BATCH_ROWS = 500
+FORWARD_MAX_IN_FLIGHT = 4
+FORWARD_TIMEOUT = 15  # seconds per request
+FORWARD_IDLE_POLL = 5  # seconds between checks when nothing new was written
+FORWARD_BACKOFF_MAX = 300
+FORWARD_STREAMS = {
+    # stream: (table, columns after id)
+    'readings': ('distance_reading', "{device}, " + EPOCH_MS_SQL.format(col='timestamp') + ", value"),
+    'events': ('alarm_event', "{device}, " + EPOCH_MS_SQL.format(col='timestamp') + ", type, detail"),
+}
+forward_wakeup = threading.Event()
+forward_stats = {'batches': 0, 'readings': 0, 'events': 0, 'failures': 0, 'last_error': None, 'cursor': {}}
+
+@on_bus('reading')
+def _wake_forwarder(message):
+    forward_wakeup.set()
+
+def read_forward_batch(conn, position):
+    """Next rows after position as ({stream: rows}, new position), or (None, position) if there are none."""
+    batch, end = {}, dict(position)
+    for stream, (table, columns) in FORWARD_STREAMS.items():
+        device = 'device' if 'device' in _table_columns(conn, table) else "'pico'"
+        rows = conn.execute(f"SELECT id, {columns.format(device=device)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                            (position[stream], FORWARD_BATCH_ROWS)).fetchall()
+        batch[stream] = [list(row) for row in rows]
+        if rows:
+            end[stream] = rows[-1][0]
+    if not any(batch.values()):
+        return None, position
+    return batch, end
+
+def post_batch(body):
+    """POST one gzipped batch; raises OSError unless the aggregator accepted it."""
+    url = urllib.parse.urlsplit(app.config['FORWARD_URL'])
+    connection = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    conn = connection(url.netloc, timeout=FORWARD_TIMEOUT)
+    try:
+        conn.request("POST", url.path or '/', body, {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+            "Authorization": f"Bearer {app.config['FORWARD_TOKEN']}",
+        })
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise OSError(f"aggregator returned HTTP {response.status}")
+    finally:
+        conn.close()
+
+def save_forward_cursor(conn, position):
+    conn.executemany(
+        "INSERT INTO forward_cursor (stream, last_id, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (stream) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at",
+        [(stream, last_id, sql_ts(datetime.utcnow())) for stream, last_id in position.items()])
+
+def forward_loop():
+    backoff = 0
+    while True:
+        batches = forward_stats['batches']
+        try:
+            run_forwarding()
+        except Exception as e:
+            # The stored cursor is where the next pass resumes, so nothing is lost
+            backoff = 0 if forward_stats['batches'] > batches else backoff
+            backoff = min(max(backoff * 2, 1), FORWARD_BACKOFF_MAX)
+            forward_stats['failures'] += 1
+            forward_stats['last_error'] = str(e)
+            print(f"❌ Forwarding stopped, restarting in {backoff}s: {e}")
+            sleep(backoff)
+
+def run_forwarding():
+    conn = open_raw_db()
+    try:
+        forward_batches(conn)
+    finally:
+        conn.close()
+
+def forward_batches(conn):
+    stored = dict(conn.execute('SELECT stream, last_id FROM forward_cursor').fetchall())
+    cursor = {stream: stored.get(stream, 0) for stream in FORWARD_STREAMS}
+    position = dict(cursor)  # rows up to here are acknowledged or in flight
+    in_flight = deque()  # (position after the batch, rows per stream, future), oldest first
+    backoff = 0
+    forward_stats['cursor'] = dict(cursor)
+    print(f"📤 Forwarding site {app.config['SITE_ID']} to {app.config['FORWARD_URL']} from {cursor}")
+    with ThreadPoolExecutor(max_workers=FORWARD_MAX_IN_FLIGHT) as pool:
+        while True:
+            while len(in_flight) < FORWARD_MAX_IN_FLIGHT:
+                batch, end = read_forward_batch(conn, position)
+                if batch is None:
+                    break
+                body = gzip.compress(json.dumps({'site': app.config['SITE_ID'], **batch}).encode())
+                counts = {stream: len(rows) for stream, rows in batch.items()}
+                in_flight.append((end, counts, pool.submit(post_batch, body)))
+                position = end
+            if not in_flight:
+                forward_wakeup.wait(FORWARD_IDLE_POLL)
+                forward_wakeup.clear()
+                continue
+            end, counts, future = in_flight[0]
+            try:
+                future.result()
+            except Exception as e:
+                for _, _, pending in in_flight:
+                    pending.exception()  # let the rest finish; they are resent either way
+                in_flight.clear()
+                position = dict(cursor)
+                backoff = min(max(backoff * 2, 1), FORWARD_BACKOFF_MAX)
+                forward_stats['failures'] += 1
+                forward_stats['last_error'] = str(e)
+                print(f"❌ Forwarding failed, retrying in {backoff}s: {e}")
+                sleep(backoff)
+                continue
+            in_flight.popleft()
+            backoff = 0
+            cursor = end
+            save_forward_cursor(conn, cursor)
+            forward_stats['batches'] += 1
+            for stream, count in counts.items():
+                forward_stats[stream] += count
+            forward_stats['cursor'] = dict(cursor)
+
+# Aggregator: batches from forwarding sites are inserted as they come and
+# duplicates (a batch resent after a timeout) are ignored by the unique keys.
+AGGREGATOR_MAX_REQUEST = 2 * 1024 * 1024  # bytes as sent, checked before decompressing
+AGGREGATOR_MAX_BODY = 16 * 1024 * 1024  # bytes after decompression
+
+@app.route('/ingest/batch', methods=['POST'])
+def ingest_batch():
+    expected = app.config['AGGREGATOR_TOKEN']
+    if not expected:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), expected.encode()):
+        abort(403)
+    request.max_content_length = AGGREGATOR_MAX_REQUEST
+    data = request.get_data()  # 413 past the limit, with or without a Content-Length
+    if request.headers.get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(data, AGGREGATOR_MAX_BODY)
+        except zlib.error as e:
+            return jsonify({'error': f'malformed batch: {e}'}), 400
+        if decompressor.unconsumed_tail:
+            abort(413)
+    try:
+        batch = json.loads(data)
+        site = str(batch['site'])[:64]
+        epoch = datetime(1970, 1, 1)
+        readings = [{'site': site, 'device': device, 'seq': seq, 'value': value,
+                     'timestamp': epoch + timedelta(milliseconds=t)}
+                    for seq, device, t, value in batch.get('readings', [])]
+        events = [{'site': site, 'device': device, 'seq': seq, 'type': kind, 'detail': detail,
+                   'timestamp': epoch + timedelta(milliseconds=t)}
+                  for seq, device, t, kind, detail in batch.get('events', [])]
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': f'malformed batch: {e}'}), 400
+    accepted = {}
+    for name, model, rows in (('readings', RemoteReading, readings), ('events', RemoteEvent, events)):
+        accepted[name] = 0
+        if rows:
+            stmt = sqlite_insert(model).on_conflict_do_nothing(index_elements=['site', 'device', 'seq'])
+            accepted[name] = db.session.connection().execute(stmt, rows).rowcount
+    db.session.commit()
+    return jsonify({'site': site, 'received': {'readings': len(readings), 'events': len(events)},
+                    'accepted': accepted})
+
+@app.route('/api/sites')
+def api_sites():
+    """Per-site totals of what forwarding sites have sent to this aggregator."""
+    readings = db.session.execute(text(
+        "SELECT site, COUNT(*), MAX(timestamp) FROM remote_reading GROUP BY site")).all()
+    events = dict(db.session.execute(text("SELECT site, COUNT(*) FROM remote_event GROUP BY site")).all())
+    sites = {site: {'readings': count, 'last_reading': str(last)[:19] if last else None, 'events': 0}
+             for site, count, last in readings}
+    for site, count in events.items():
+        sites.setdefault(site, {'readings': 0, 'last_reading': None})['events'] = count
+    return jsonify(sites)
+
+# Ingest journal
+#
+# Distance messages are appended to instance/ingest.journal and fsynced before
+# the MQTT callback returns (and so before paho acknowledges a QoS 1 publish).
+# The LSN of the last record applied is stored in IngestCheckpoint in the same
+# transaction as the readings, so replay after a crash is exactly-once.
+# paho delivers messages on a single thread and sends the PUBACK only after
+# the callback returns, so records cannot be batched: each message costs one
+# fsync (a few ms on an SD card), which caps ingest at a few hundred messages
+# a second. The Pico's batched payloads spread that cost over many samples.
+# A record whose readings cannot be written is retried until they are: the
+# checkpoint only moves forward, so the next message would otherwise carry it
+# past a record that was never applied.
+# Record: crc32, lsn, received (epoch s), topic length, payload length.
+JOURNAL_RECORD = struct.Struct('<IQdHI')
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024  # records up to the checkpoint are dropped past this size
+JOURNAL_TOPICS = ('motion/distance',)
+JOURNAL_RETRY_MAX = 30  # seconds between attempts to apply a record
+journal = {'file': None, 'lsn': 0, 'compact_at': JOURNAL_MAX_BYTES}
+journal_write_lock = threading.Lock()
+
+def journal_path():
+    return os.path.join(app.instance_path, 'ingest.journal')
+
+def read_journal(path):
+    """Yield (lsn, received, topic, raw, end_offset) up to the first torn or corrupt record."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    offset = 0
+    while offset + JOURNAL_RECORD.size <= len(data):
+        crc, lsn, received, topic_len, payload_len = JOURNAL_RECORD.unpack_from(data, offset)
+        body_start = offset + JOURNAL_RECORD.size
+        end = body_start + topic_len + payload_len
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            return
+        topic = data[body_start:body_start + topic_len].decode()
+        yield lsn, received, topic, data[body_start + topic_len:end], end
+        offset = end
+
+def journal_checkpoint():
+    with app.app_context():
+        row = db.session.get(IngestCheckpoint, 'journal')
+        return row.lsn if row else 0
+
+def open_journal():
+    """Replay records the DB has not seen, then open the journal for appending."""
+    path = journal_path()
+    checkpoint = journal_checkpoint()
+    last_lsn, valid_end, replayed = checkpoint, 0, 0
+    for lsn, received, topic, raw, end in read_journal(path):
+        valid_end = end
+        last_lsn = max(last_lsn, lsn)
+        if lsn > checkpoint:
+            process_message(topic, raw, received=datetime.utcfromtimestamp(received), lsn=lsn, replay=True)
+            replayed += 1
+    if replayed:
+        print(f"📼 Replayed {replayed} journaled messages after LSN {checkpoint}")
+    f = open(path, 'ab')
+    f.truncate(valid_end)  # drop a torn tail left by the crash
+    os.fsync(f.fileno())
+    journal.update(file=f, lsn=last_lsn)
+
+def compact_journal():
+    """Drop the records the checkpoint has passed; caller holds journal_write_lock."""
+    path, checkpoint = journal_path(), journal_checkpoint()
+    start = None
+    previous_end = 0
+    for lsn, _, _, _, end in read_journal(path):
+        if lsn > checkpoint:
+            start = previous_end
+            break
+        previous_end = end
+    if start is None:
+        journal['file'].truncate(0)
+        journal['compact_at'] = JOURNAL_MAX_BYTES
+        return
+    with open(path, 'rb') as f:
+        f.seek(start)
+        tail = f.read()
+    with open(path + '.tmp', 'wb') as f:
+        f.write(tail)
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    journal['file'].close()
+    journal['file'] = open(path, 'ab')
+    # A checkpoint stuck behind must not make every append copy the tail again
+    journal['compact_at'] = max(JOURNAL_MAX_BYTES, 2 * len(tail))
+    print(f"📼 Journal compacted to the {len(tail)} bytes after LSN {checkpoint}")
+
+def journal_append(topic, raw, received):
+    """Append a message and return its LSN once it is on disk."""
+    topic_bytes = topic.encode()
+    with journal_write_lock:
+        if journal['file'].tell() > journal['compact_at']:
+            compact_journal()
+        f = journal['file']
+        lsn = journal['lsn'] = journal['lsn'] + 1
+        body = struct.pack('<QdHI', lsn, to_epoch_ms(received) / 1000, len(topic_bytes), len(raw)) + topic_bytes + raw
+        f.write(struct.pack('<I', zlib.crc32(body)) + body)
+        f.flush()
+        os.fsync(f.fileno())
+    return lsn
+
+def save_journaled(device, rows, lsn):
+    """save_readings, retried until it commits when the message is journaled."""
+    delay = 1
+    while True:
+        try:
+            return save_readings(device, rows, lsn)
+        except sqlite3.Error as e:
+            if lsn is None:
+                raise
+            print(f"❌ Could not apply journal record {lsn}, retrying in {delay}s: {e}")
+            sleep(delay)
+            delay = min(delay * 2, JOURNAL_RETRY_MAX)
+
+# Set by main() once the journal is replayed; the broker may be connected earlier
+ingest_ready = threading.Event()
+subscribe_lock = threading.Lock()
+
+def subscribe_topics():
+    """Subscribe as soon as both the broker connection and the ingest path are up."""
+    with subscribe_lock:
+        if not (mqtt.connected and ingest_ready.is_set()):
+            return
+        mqtt.subscribe('motion/distance', qos=1)  # acknowledged only after the journal fsync
+        mqtt.subscribe('device/status')
+        # Not device/alarm: it only carries our own unversioned toggles back, and
+        # every process already gets them, with their version, from the event bus
+        mqtt.subscribe('device/alarm/request')
+        mqtt.unsubscribe('device/alarm')  # the persistent session may still hold it
+        print("🔄 Subscribed to topics: motion/distance, device/status, device/alarm/request")
+        if startup['ready_after'] is None:
+            startup_phase('mqtt connect')
+            startup_report('Alarm live')
 
 @mqtt.on_connect()
 def handle_connect(client, userdata, flags, rc):
     if rc == 0:
         print("✅ MQTT connected successfully.")
-        mqtt.subscribe('motion/distance')
-        mqtt.subscribe('device/status')
-        mqtt.subscribe('device/alarm/request')
-        print("🔄 Subscribed to topics: motion/distance, device/status, device/status/requests")
+        subscribe_topics()
     else:
         print(f"❌ MQTT failed to connect. Return code: {rc}")
 
 @mqtt.on_message()
 def handle_message(client, userdata, message):
-    topic = message.topic
-    payload = message.payload.decode()
+    # A persistent session redelivers queued messages on connect, possibly before the replay
+    ingest_ready.wait()
+    trace = start_trace(message.topic)
+    try:
+        received, lsn = datetime.utcnow(), None
+        if journal['file'] is not None and message.topic in JOURNAL_TOPICS:
+            lsn = journal_append(message.topic, message.payload, received)
+            trace_mark('journaled')
+        process_message(message.topic, message.payload, received, lsn)
+    finally:
+        finish_trace(trace)
+
+def process_message(topic, raw, received=None, lsn=None, replay=False):
+    """Apply one MQTT message; replayed journal records only restore data, without side effects."""
+    payload = raw.decode(errors='replace')  # batched distance payloads may be binary
     
     if topic == 'motion/distance':
         try:
-            dist = float(payload)
-            print(f"📩 Received from MQTT: {dist} m")
-            if 0 < dist < 5:
-                with app.app_context():
-                    reading = DistanceReading(value=dist * 100.0)
-                    db.session.add(reading)
-                    db.session.commit()
-                    print(f"✅ Saved to database as {dist * 100.0:.2f} cm")
+            device, seq, samples = decode_distance_payload(raw, received or datetime.utcnow())
+            trace_mark('parsed')
+            if not replay:
+                observe_liveness(device, 'online')
+            if not check_sequence(device, seq, len(samples)):
+                print(f"♻️ Dropped duplicate batch {seq} from {device}")
+                if lsn is not None:
+                    save_journaled(device, [], lsn)
+                return
+            if seq is None:
+                print(f"📩 Received from MQTT: {samples[0][1]} m")
+            else:
+                print(f"📩 Received batch of {len(samples)} samples from {device} (seq {seq})")
+            valid = [(ts, dist * 100.0) for ts, dist in samples if 0 < dist < 5]
+            if not valid and lsn is not None:
+                save_journaled(device, [], lsn)
+            if valid:
+                save_journaled(device, valid, lsn)
+                trace_mark('persisted')
+                print(f"✅ Saved to database as {', '.join(f'{cm:.2f}' for _, cm in valid[:5])}{' ...' if len(valid) > 5 else ''} cm")
+                for ts, cm in valid:
+                    update_rollup(device, ts, cm)
+                    update_episode(device, ts, cm)
+                if replay:
+                    return  # alarms and sampling commands for a past reading would be stale
+                last_ts, last_cm = valid[-1]
+                bus_publish('reading', device=device, value=last_cm, t=to_epoch_ms(last_ts), count=len(valid))
+                trace_mark('pushed')
+                # The closest sample of a batch decides the alarm
+                dist = min(cm for _, cm in valid) / 100.0
 
 		# 🔔 ALARM TRIGGER CHECK
+                trace_mark('alarm_evaluated')
                 if dist < 0.2 and alarm_state['enabled']:
-                    now = time()
-                    if now - last_pushover_time['timestamp'] > PUSHOVER_COOLDOWN:
-                        last_pushover_time['timestamp'] = now
-                        print("🚨 Triggering alarm notification via Pushover...")
-                        try:
-                            conn = http.client.HTTPSConnection("api.pushover.net:443")
-                            conn.request("POST", "/1/messages.json",
-                                urllib.parse.urlencode({
-                                    "token": "aht73m2ii3vyotoz58swdkhrdmya4f",
-                                    "user": "upcm7jkikk2p2i16i7dfxicnwqodp9",
-                                    "message": f"🚨 Alarm Triggered! Object too close: {dist*100:.1f} cm",
-                                }), { "Content-type": "application/x-www-form-urlencoded" })
-                            conn.getresponse()
-                        except Exception as e:
-                            print(f"❌ Error sending Pushover message: {e}")
+                    if allow_notification('trigger', device, cm=dist * 100):
+                        print("🚨 Triggering alarm notification...")
                         with app.app_context():
                             event = AlarmEvent(type='triggered', detail=f'Object too close: {dist*100:.1f} cm')
                             db.session.add(event)
+                            rows = enqueue_notification('trigger', f"🚨 Alarm Triggered! Object too close: {dist*100:.1f} cm")
                             db.session.commit()
+                            trace_mark('event_persisted')
+                            queued(rows)
                     else:
-                        print("⏳ Skipping pushover: cooldown active")
+                        print("⏳ Skipping notification: cooldown active, added to digest")
+            update_sampling(device, min(cm for _, cm in valid) if valid else None)
         except Exception as e:
             print(f"❌ Error processing distance: {e}")
 
     elif topic == 'device/status':
         print(f"�� Pico W status update: {payload}")
-        set_pico_status(payload)
-
-        if payload == "online":
-            try:
-                conn = http.client.HTTPSConnection("api.pushover.net:443")
-                conn.request("POST", "/1/messages.json",
-                    urllib.parse.urlencode({
-                        "token": "aht73m2ii3vyotoz58swdkhrdmya4f",
-                        "user": "upcm7jkikk2p2i16i7dfxicnwqodp9",
-                        "message": "📶 Pico W is now online and connected.",
-                    }), { "Content-type": "application/x-www-form-urlencoded" })
-                conn.getresponse()
-                print("✅ Pushover: Pico online message sent.")
-            except Exception as e:
-                print(f"❌ Error sending Pushover (online): {e}")
-
-        elif payload == "offline":
-            try:
-                conn = http.client.HTTPSConnection("api.pushover.net:443")
-                conn.request("POST", "/1/messages.json",
-                    urllib.parse.urlencode({
-                        "token": "aht73m2ii3vyotoz58swdkhrdmya4f",
-                        "user": "upcm7jkikk2p2i16i7dfxicnwqodp9",
-                        "message": "🔌 Pico W is offline or disconnected.",
-                    }), { "Content-type": "application/x-www-form-urlencoded" })
-                conn.getresponse()
-                print("✅ Pushover: Pico offline message sent.")
-            except Exception as e:
-                print(f"❌ Error sending Pushover (offline): {e}")
-
+        # Also covers the Pico's MQTT last will, which publishes "offline" here
+        if payload in ('online', 'offline'):
+            observe_liveness('pico', payload)
 
     elif topic == 'device/alarm/request':
         print("🔄 Pico requested current alarm state.")
         state = 'on' if alarm_state['enabled'] else 'off'
         mqtt.publish('device/alarm', state)
+        trace_mark('published')
         print(f"✅ Sent alarm state: {state}")
 
 
 
 
-def start_mqtt():
+def process_age():
+    """Seconds since this process was started, from /proc (None elsewhere)."""
     try:
-        mqtt.client.connect(app.config['MQTT_BROKER_URL'], app.config['MQTT_BROKER_PORT'], 60)
-        print("📶 MQTT manual connection attempted.")
-        mqtt.client.loop_start()
-        print("📡 MQTT loop started.")
-    except Exception as e:
-        print(f"❌ Failed to connect to MQTT broker: {e}")
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+def startup_report(what):
+    """Print how long each startup phase took; the interpreter's own start comes first."""
+    elapsed = perf_counter() - startup['started']
+    age = process_age()
+    if age is not None and age > elapsed:
+        startup['phases'].insert(0, ('interpreter', age - elapsed))
+        elapsed = age
+    startup['ready_after'] = elapsed
+    print(f"⏱️ {what} {elapsed:.2f} s after start:")
+    for name, seconds in startup['phases']:
+        print(f"   {name:<26}{seconds:6.2f} s")
+
+def background_startup():
+    """Database maintenance the alarm path does not have to wait for."""
+    started = perf_counter()
+    run_migrations()  # also (re)creates STARTUP_INDEXES
+    startup['background']['maintenance'] = perf_counter() - started
+    print(f"⏱️ Background maintenance done in {startup['background']['maintenance']:.2f} s")
+
+startup_phase('routes and handlers')
+load_alarm_state()
+startup_phase('alarm state')
+if not INGEST:
+    start_bus()
+    threading.Thread(target=memory_gauge_loop, daemon=True).start()  # web workers never run main()
+    startup_phase('event bus')
+    startup_report('Ready to serve')
+
+def main():
+    if APP_ROLE == 'ingest' and not INGEST:
+        sys.exit("❌ Another ingest process is already running.")
+    if BACKUP_KEEP < 1:
+        sys.exit(f"❌ BACKUP_KEEP must be at least 1, not {BACKUP_KEEP}.")
+    if INGEST:
+        # The alarm path first: replay the journal, then subscribe; the rest can wait
+        start_bus()
+        close_orphaned_episodes()
+        rebuild_rollups()
+        seed_liveness()
+        atexit.register(sweep_rollups)  # the open minutes; SIGTERM exits through atexit too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        open_journal()
+        threading.Thread(target=outbox_sender_loop, daemon=True).start()
+        threading.Thread(target=liveness_loop, daemon=True).start()
+        startup_phase('recovery')
+        ingest_ready.set()
+        subscribe_topics()
+        threading.Thread(target=background_startup, daemon=True).start()
+        threading.Thread(target=backup_loop, daemon=True).start()
+        threading.Thread(target=archive_loop, daemon=True).start()
+        threading.Thread(target=compact_loop, daemon=True).start()
+        if app.config['FORWARD_URL']:
+            threading.Thread(target=forward_loop, daemon=True).start()
+        threading.Thread(target=memory_gauge_loop, daemon=True).start()
+    if APP_ROLE == 'ingest':
+        # Web traffic goes to the WSGI workers; keep /debug and /migrations reachable locally.
+        app.run(host='127.0.0.1', port=int(os.environ.get('PORT', 5001)))
+    else:
+        app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
 
 if __name__ == '__main__':
-    threading.Thread(target=start_mqtt).start()
-    app.run(host='0.0.0.0', port=5000)
-
+    main()
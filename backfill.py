@@ -0,0 +1,281 @@
+"""Rebuild derived data from the raw distance_reading history.
+
+Splits the time range into partitions that are read in parallel by a process
+pool, with read-only plain sqlite3 cursors. The results are written back by
+this process in partition order, a chunk at a time:
+
+    python backfill.py rollups                      # minute rollups and their sketches
+    python backfill.py episodes --from 2025-01-01   # intrusion episodes
+    python backfill.py rollups --restart            # ignore a previous run's checkpoint
+
+Each partition's rows replace whatever was stored for its range, so re-running
+a partition is harmless. Progress is checkpointed in backfill_checkpoint, and
+an interrupted run resumes where it stopped. Workers run at a lower CPU
+priority and writes pause between chunks, so live ingest keeps going.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+os.environ.setdefault('APP_ROLE', 'web')  # never take the ingest lock or connect to MQTT
+import app as dashboard  # noqa: E402
+
+WRITE_CHUNK = 500  # rows per write transaction
+
+
+def open_readonly(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+
+def readings_sql(conn, where=''):
+    # Readings written before migration 0001 have no device column; they all came from the Pico
+    device = 'device' if 'device' in dashboard._table_columns(conn, 'distance_reading') else "'pico'"
+    return (f"SELECT {device}, timestamp, value FROM distance_reading "
+            f"WHERE timestamp >= ? AND timestamp < ?{where.format(device=device)} ORDER BY timestamp")
+
+
+def write_chunks(conn, sql, rows, pause):
+    for i in range(0, len(rows), WRITE_CHUNK):
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(sql, rows[i:i + WRITE_CHUNK])
+        conn.execute('COMMIT')
+        time.sleep(pause)
+
+
+# Rollups: partitions start on whole minutes, so no minute spans two partitions.
+
+def rollup_partition(path, start, end):
+    conn = open_readonly(path)
+    buckets = {}
+    for device, ts, value in conn.execute(readings_sql(conn), (start, end)):
+        key = (device, ts[:16] + ':00.000000')  # the minute, in the format SQLAlchemy stores
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, value, value, value, dashboard.TDigest([(value, 1)])]
+            continue
+        bucket[0] += 1
+        bucket[1] += value
+        bucket[2] = min(bucket[2], value)
+        bucket[3] = max(bucket[3], value)
+        bucket[4].add(value)
+    conn.close()
+    return [(device, minute, count, total, low, high, sketch.to_bytes(dashboard.ROLLUP_SKETCH_COMPRESSION))
+            for (device, minute), (count, total, low, high, sketch) in sorted(buckets.items())]
+
+
+def write_rollups(conn, start, end, rows, pause):
+    # Only the devices with readings here were recomputed; other rollups stay
+    devices = sorted({row[0] for row in rows})
+    if devices:
+        conn.execute(f"DELETE FROM distance_rollup WHERE bucket >= ? AND bucket < ? "
+                     f"AND device IN ({', '.join('?' * len(devices))})",
+                     (dashboard.sql_ts(start), dashboard.sql_ts(end), *devices))
+    write_chunks(conn, 'INSERT OR REPLACE INTO distance_rollup '
+                 '(device, bucket, count, value_sum, value_min, value_max, sketch) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                 rows, pause)
+    if devices:
+        # Hours merged from the old minutes are stale; the ingest process merges them again
+        conn.execute(f"DELETE FROM distance_rollup_hour WHERE bucket >= ? AND bucket < ? "
+                     f"AND device IN ({', '.join('?' * len(devices))})",
+                     (dashboard.sql_ts(dashboard.hour_bucket(start)), dashboard.sql_ts(end), *devices))
+    return end
+
+
+def rollup_range_end(conn, until):
+    # The ingest process merges its open minute into the stored row when it
+    # flushes, so never write past the newest minute it has flushed already.
+    newest = conn.execute('SELECT MAX(bucket) FROM distance_rollup').fetchone()[0]
+    if newest is not None:
+        until = min(until, datetime.fromisoformat(newest) + timedelta(minutes=1))
+    return until
+
+
+# Episodes: one can cross a partition boundary, so each partition reports the
+# episodes it saw per device and adjacent partitions are stitched together here.
+
+def episode_partition(path, start, end):
+    conn = open_readonly(path)
+    episodes = {}  # device -> [[start, last, min, samples], ...]
+    for device, ts, value in conn.execute(readings_sql(conn, ' AND value < ?'),
+                                          (start, end, dashboard.EPISODE_THRESHOLD_CM)):
+        ts = datetime.fromisoformat(ts)
+        device_episodes = episodes.setdefault(device, [])
+        if device_episodes and ts - device_episodes[-1][1] <= dashboard.EPISODE_GAP:
+            episode = device_episodes[-1]
+            episode[1] = ts
+            episode[2] = min(episode[2], value)
+            episode[3] += 1
+        else:
+            device_episodes.append([ts, ts, value, 1])
+    conn.close()
+    return episodes
+
+
+def close_reading_between(conn, device, start, end):
+    return conn.execute(readings_sql(conn, ' AND value < ? AND {device} = ?'),
+                        (dashboard.sql_ts(start), dashboard.sql_ts(end),
+                         dashboard.EPISODE_THRESHOLD_CM, device)).fetchone() is not None
+
+
+class EpisodeWriter:
+    """Stitches partitions together; an episode is written once it can no longer grow."""
+
+    def __init__(self, conn, range_from, range_until):
+        self.range_from = range_from
+        self.range_until = range_until
+        self.done = range_from
+        self.open = {}  # device -> last episode seen, which the next partition may extend
+        self.ready = []  # (device, episode) waiting for the earliest open episode to finish
+
+    def __call__(self, conn, start, end, episodes, pause):
+        gap = dashboard.EPISODE_GAP
+        for device, device_episodes in episodes.items():
+            if start == self.range_from and device_episodes and device_episodes[0][0] - start <= gap \
+                    and close_reading_between(conn, device, start - gap, start):
+                device_episodes.pop(0)  # began before the range; its stored row stays as it is
+            held = self.open.pop(device, None)
+            if held is not None and device_episodes and device_episodes[0][0] - held[1] <= gap:
+                first = device_episodes[0]
+                device_episodes[0] = [held[0], first[1], min(held[2], first[2]), held[3] + first[3]]
+            elif held is not None:
+                self.ready.append((device, held))
+            if device_episodes:
+                self.open[device] = device_episodes.pop()
+            self.ready.extend((device, episode) for episode in device_episodes)
+
+        continuing = {}
+        for device, held in list(self.open.items()):
+            if end - held[1] > gap:
+                self.ready.append((device, self.open.pop(device)))
+            elif end >= self.range_until:
+                if close_reading_between(conn, device, end, end + gap):
+                    continuing[device] = self.open.pop(device)[0]  # still running; left to the stored row
+                else:
+                    self.ready.append((device, self.open.pop(device)))
+
+        # Everything starting before the earliest still-open episode is final
+        cut = min([held[0] for held in self.open.values()], default=end)
+        rows = [(device, dashboard.sql_ts(first), dashboard.sql_ts(last), low, samples,
+                 dashboard.SAMPLING_BANDS[dashboard.sampling_band(low)][1])
+                for device, (first, last, low, samples) in self.ready
+                if first < cut and first < continuing.get(device, cut)]
+        self.ready = [(device, episode) for device, episode in self.ready if episode[0] >= cut]
+        keep = ''.join(' AND NOT (device = ? AND started_at >= ?)' for _ in continuing)
+        params = [p for device, first in continuing.items() for p in (device, dashboard.sql_ts(first))]
+        conn.execute('DELETE FROM episode WHERE started_at >= ? AND started_at < ?' + keep,
+                     [dashboard.sql_ts(self.done), dashboard.sql_ts(cut), *params])
+        write_chunks(conn, 'INSERT INTO episode (device, started_at, ended_at, min_value, samples, peak_band) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', rows, pause)
+        self.done = cut
+        return cut
+
+
+JOBS = {
+    # name: (partition reader run in the pool, factory for the writer run in this process)
+    'rollups': (rollup_partition, lambda conn, range_from, range_until: write_rollups),
+    'episodes': (episode_partition, EpisodeWriter),
+}
+
+
+def lower_priority(niceness):
+    os.nice(niceness)
+
+
+def load_checkpoint(conn, job):
+    row = conn.execute('SELECT range_from, range_until, done_until FROM backfill_checkpoint WHERE job = ?',
+                       (job,)).fetchone()
+    return None if row is None else tuple(datetime.fromisoformat(v) for v in row)
+
+
+def save_checkpoint(conn, job, range_from, range_until, done_until):
+    conn.execute(
+        'INSERT INTO backfill_checkpoint (job, range_from, range_until, done_until, updated_at) '
+        'VALUES (?, ?, ?, ?, ?) ON CONFLICT (job) DO UPDATE SET range_from = excluded.range_from, '
+        'range_until = excluded.range_until, done_until = excluded.done_until, updated_at = excluded.updated_at',
+        (job, dashboard.sql_ts(range_from), dashboard.sql_ts(range_until), dashboard.sql_ts(done_until),
+         dashboard.sql_ts(datetime.utcnow())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('job', choices=sorted(JOBS))
+    parser.add_argument('--from', dest='start', help='ISO start (default: the first reading)')
+    parser.add_argument('--to', dest='end', help='ISO end (default: the start of the current hour)')
+    parser.add_argument('--partition-hours', type=float, default=24)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep after each write chunk')
+    parser.add_argument('--nice', type=int, default=10, help='CPU niceness for the worker processes')
+    parser.add_argument('--restart', action='store_true', help='ignore an unfinished previous run')
+    args = parser.parse_args()
+
+    read_partition, writer_class = JOBS[args.job]
+    conn = dashboard.open_raw_db()
+    with dashboard.app.app_context():
+        path = dashboard.db.engine.url.database
+
+    checkpoint = None if args.restart else load_checkpoint(conn, args.job)
+    if checkpoint is not None and checkpoint[2] < checkpoint[1] and not (args.start or args.end):
+        range_from, range_until, start = checkpoint
+        print(f"⏩ Resuming {args.job} backfill at {start}")
+    else:
+        first = conn.execute('SELECT MIN(timestamp) FROM distance_reading').fetchone()[0]
+        if first is None and not args.start:
+            sys.exit("Nothing to backfill: distance_reading is empty.")
+        range_from = dashboard.rollup_bucket(dashboard.parse_time_arg(args.start, None)
+                                             or datetime.fromisoformat(first))
+        range_until = dashboard.parse_time_arg(args.end, datetime.utcnow().replace(minute=0, second=0, microsecond=0))
+        if args.job == 'rollups':
+            range_until = rollup_range_end(conn, range_until)
+        archived = dashboard.archived_until()
+        if archived is not None and range_from < archived:
+            # Archived days have no rows left in distance_reading to rebuild from
+            print(f"⚠️ Readings before {archived} are archived; starting there")
+            range_from = archived
+        start = range_from
+    if start >= range_until:
+        sys.exit(f"Nothing to backfill before {range_until}.")
+
+    step = max(timedelta(hours=args.partition_hours), timedelta(minutes=1))
+    partitions = []
+    while start < range_until:
+        end = min(dashboard.rollup_bucket(start + step), range_until)
+        partitions.append((start, end))
+        start = end
+    print(f"🔁 Backfilling {args.job} from {range_from} to {range_until}: "
+          f"{len(partitions)} partitions on {args.workers} workers")
+
+    write = writer_class(conn, partitions[0][0], range_until)
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=lower_priority, initargs=(args.nice,)) as pool:
+        # A bounded window of partitions in flight keeps memory flat on long ranges
+        pending = deque()
+        remaining = iter(partitions)
+        for part in remaining:
+            pending.append((part, pool.submit(read_partition, path, dashboard.sql_ts(part[0]), dashboard.sql_ts(part[1]))))
+            if len(pending) >= 2 * args.workers:
+                break
+        done = 0
+        while pending:
+            (part_start, part_end), future = pending.popleft()
+            result = future.result()
+            done_until = write(conn, part_start, part_end, result, args.pause)
+            save_checkpoint(conn, args.job, range_from, range_until, done_until)
+            done += 1
+            print(f"  {part_start} - {part_end} ({done}/{len(partitions)}, {time.monotonic() - started:.1f}s)")
+            part = next(remaining, None)
+            if part is not None:
+                pending.append((part, pool.submit(read_partition, path, dashboard.sql_ts(part[0]),
+                                                  dashboard.sql_ts(part[1]))))
+    save_checkpoint(conn, args.job, range_from, range_until, range_until)
+    print(f"✅ {args.job} backfill finished in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
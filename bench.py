@@ -0,0 +1,112 @@
+"""Dashboard throughput benchmark.
+
+Starts the web role under gunicorn with each requested worker count and hits
+the endpoints the dashboard polls, from several client processes, so the
+numbers are not limited by the benchmark's own GIL:
+
+    APP_ROLE=ingest python app.py &                      # owns MQTT and writes
+    python bench.py --workers 1,2,4 --clients 8 --seconds 20
+
+Use --url to benchmark an already running server instead.
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+PATHS = ['/latest', '/alarm/state', '/pico/status', '/api/chart?points=500']
+
+
+def client(base_url, seconds):
+    """Keep-alive request loop; returns a list of per-request latencies in seconds."""
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < deadline:
+        path = PATHS[i % len(PATHS)]
+        i += 1
+        start = time.monotonic()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+            continue
+        latencies.append(time.monotonic() - start)
+    conn.close()
+    return latencies, errors
+
+
+def run_load(base_url, clients, seconds):
+    with ProcessPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(client, [base_url] * clients, [seconds] * clients))
+    latencies = sorted(l for result, _ in results for l in result)
+    errors = sum(e for _, e in results)
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    return len(latencies) / seconds, p50, p95, errors
+
+
+def wait_until_up(base_url, timeout=60):
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request('GET', '/pico/status')
+            conn.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated gunicorn worker counts')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    parser.add_argument('--seconds', type=int, default=20, help='load duration per run')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--url', help='benchmark this running server instead of starting gunicorn')
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    if args.url:
+        rate, p50, p95, errors = run_load(args.url, args.clients, args.seconds)
+        print(f"{'-':>8} {rate:10.1f} {p50:8.1f} {p95:8.1f} {errors:7d}")
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    base_url = f"http://127.0.0.1:{args.port}"
+    for workers in [int(w) for w in args.workers.split(',')]:
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f"127.0.0.1:{args.port}", 'app:app'],
+            cwd=here, env={**os.environ, 'APP_ROLE': 'web'},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_until_up(base_url):
+                sys.exit(f"gunicorn with {workers} workers did not come up (is gunicorn installed?)")
+            rate, p50, p95, errors = run_load(base_url, args.clients, args.seconds)
+            print(f"{workers:>8} {rate:10.1f} {p50:8.1f} {p95:8.1f} {errors:7d}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Per-operation cost of the hot data paths: the ORM versus app.py's sqlite3 layer.
+
+Runs against a scratch database in a temporary instance directory, so it is
+safe to run next to a live install:
+
+    python bench_queries.py --rows 20000 --repeat 2000
+
+For each operation it prints the CPU time per call (time.process_time, with
+tracemalloc off) and the memory allocated per call (tracemalloc peak above
+the starting point). "orm" is how app.py did it through Flask-SQLAlchemy and
+"raw" is the pooled sqlite3 connection with cached prepared statements that
+it uses now.
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from itertools import count
+from time import process_time
+
+os.environ['APP_ROLE'] = 'web'  # never take the ingest lock or connect to MQTT
+os.environ.setdefault('INSTANCE_PATH', tempfile.mkdtemp(prefix='bench-queries-'))
+import app as dashboard  # noqa: E402
+from app import db, DistanceReading, IngestCheckpoint, PicoStatus  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert  # noqa: E402
+
+ALLOC_SAMPLES = 200  # tracemalloc slows calls down a lot; fewer calls are enough
+
+
+def seed(rows):
+    """rows readings one second apart, ending now; returns the time of the last one."""
+    end = datetime.utcnow()
+    with dashboard.hot_db() as conn:
+        conn.execute('BEGIN')
+        conn.executemany(dashboard.INSERT_READING_SQL,
+                         [(dashboard.sql_ts(end - timedelta(seconds=rows - i)), 50.0 + i % 300, 'pico')
+                          for i in range(rows)])
+        conn.execute('COMMIT')
+    return end
+
+
+# The ORM versions are the code app.py ran before the sqlite3 layer. The MQTT
+# and liveness threads pushed an app context per call; HTTP handlers already
+# run inside one, so the read benchmarks run in a single pushed context.
+
+def orm_insert(ts, cm, lsn):
+    with dashboard.app.app_context():
+        db.session.execute(DistanceReading.__table__.insert(), [{'value': cm, 'timestamp': ts}])
+        stmt = sqlite_insert(IngestCheckpoint).values(name='journal', lsn=lsn, updated_at=datetime.utcnow())
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'lsn': db.func.max(IngestCheckpoint.lsn, stmt.excluded.lsn), 'updated_at': stmt.excluded.updated_at}))
+        db.session.commit()
+
+
+def orm_latest():
+    rows = DistanceReading.query.filter_by(device='pico').order_by(DistanceReading.timestamp.desc()).limit(10).all()
+    return [(r.timestamp, r.value) for r in rows]
+
+
+def orm_range(start, end):
+    return db.session.execute(text(
+        f"SELECT {dashboard.EPOCH_MS_SQL.format(col='timestamp')}, value FROM distance_reading "
+        "WHERE device = 'pico' AND timestamp >= :start AND timestamp < :end ORDER BY timestamp"),
+        {'start': dashboard.sql_ts(start), 'end': dashboard.sql_ts(end)}).fetchall()
+
+
+def orm_status(state):
+    with dashboard.app.app_context():
+        existing = PicoStatus.query.first()
+        if existing:
+            existing.status = state
+            existing.timestamp = datetime.utcnow()
+        else:
+            db.session.add(PicoStatus(status=state))
+        db.session.commit()
+
+
+def measure(fn, repeat):
+    """(CPU seconds, bytes allocated) per call."""
+    fn()  # first call opens connections and fills the statement caches
+    started = process_time()
+    for _ in range(repeat):
+        fn()
+    cpu = (process_time() - started) / repeat
+    samples = min(repeat, ALLOC_SAMPLES)
+    allocated = 0
+    tracemalloc.start()
+    for _ in range(samples):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return cpu, allocated / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='readings to seed, one per second')
+    parser.add_argument('--repeat', type=int, default=2000, help='calls per operation and implementation')
+    parser.add_argument('--range-minutes', type=int, default=60, help='length of the range scan')
+    args = parser.parse_args()
+
+    dashboard.run_migrations()  # the production schema, with its timestamp index
+    end = seed(args.rows)
+    start = end - timedelta(minutes=args.range_minutes)
+    clock, lsn = count(), count(1)
+    base = end + timedelta(days=1)  # inserted rows stay out of the scanned range
+
+    def next_ts():
+        return base + timedelta(milliseconds=next(clock))
+
+    operations = [
+        ('insert reading', lambda: orm_insert(next_ts(), 42.0, next(lsn)),
+         lambda: dashboard.save_readings('pico', [(next_ts(), 42.0)], next(lsn))),
+        ('latest 10', orm_latest, lambda: dashboard.newest_readings(10)),
+        (f'range {args.range_minutes} min', lambda: orm_range(start, end), lambda: dashboard.reading_range(start, end)),
+        ('status upsert', lambda: orm_status('online'), lambda: dashboard.set_pico_status('online')),
+    ]
+    print(f"{'operation':<16} {'orm µs':>9} {'raw µs':>9} {'orm KiB':>9} {'raw KiB':>9} {'speedup':>8}")
+    with dashboard.app.app_context():
+        for name, orm, raw in operations:
+            orm_cpu, orm_bytes = measure(orm, args.repeat)
+            raw_cpu, raw_bytes = measure(raw, args.repeat)
+            print(f"{name:<16} {orm_cpu * 1e6:9.1f} {raw_cpu * 1e6:9.1f} "
+                  f"{orm_bytes / 1024:9.1f} {raw_bytes / 1024:9.1f} {orm_cpu / raw_cpu:7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Shared fixtures: app.py imported as a web worker on a scratch instance directory.
+
+The web role never takes the ingest lock or connects to MQTT, so the tests are
+safe to run next to a live install. INSTANCE_PATH is always replaced, never
+inherited, so they cannot touch a real database.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ['APP_ROLE'] = 'web'
+os.environ['INSTANCE_PATH'] = tempfile.mkdtemp(prefix='pi-zero-tests-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as dashboard  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(dashboard.app.instance_path, ignore_errors=True)
+
+
+class StandIn(ThreadingHTTPServer):
+    """Local HTTP server that records POSTs and can be switched down (HTTP 503) and up again."""
+
+    def __init__(self):
+        self.up = True
+        self.status = 200  # returned while up
+        self.requests = []
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status = self.server.status if self.server.up else 503
+        if self.server.up:
+            self.server.requests.append((self.path, dict(self.headers), body))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app_context():
+    with dashboard.app.app_context():
+        yield
+
+
+@pytest.fixture
+def outbox(app_context):
+    """An empty outbox and fresh per-channel counters; the channel config is restored afterwards."""
+    config = {key: dashboard.app.config[key] for key in ('NOTIFY_CHANNELS', 'PUSHOVER_URL')}
+    dashboard.db.session.query(dashboard.NotificationOutbox).delete()
+    dashboard.db.session.commit()
+    dashboard.channel_stats.clear()
+    yield
+    dashboard.app.config.update(config)
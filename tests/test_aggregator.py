@@ -0,0 +1,110 @@
+"""Aggregator receive mode: /ingest/batch deduplicates by (site, device, seq) and rejects bad batches."""
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+from conftest import dashboard
+
+db = dashboard.db
+TOKEN = 'test-aggregator-token'
+
+
+@pytest.fixture
+def client(app_context):
+    tokens = {key: dashboard.app.config[key] for key in ('AGGREGATOR_TOKEN', 'SITE_ID')}
+    dashboard.app.config.update(AGGREGATOR_TOKEN=TOKEN, SITE_ID='test-site')
+    for model in (dashboard.RemoteReading, dashboard.RemoteEvent):
+        db.session.query(model).delete()
+    db.session.commit()
+    yield dashboard.app.test_client()
+    dashboard.app.config.update(tokens)
+
+
+def post(client, batch, token=TOKEN, compress=True):
+    body = json.dumps(batch).encode() if not isinstance(batch, bytes) else batch
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return client.post('/ingest/batch', data=body, headers=headers)
+
+
+def stored():
+    return (db.session.query(dashboard.RemoteReading).count(), db.session.query(dashboard.RemoteEvent).count())
+
+
+BATCH = {
+    'site': 'garage',
+    'readings': [[1, 'pico', 1714521600000, 42.5], [2, 'pico', 1714521601000, 41.0]],
+    'events': [[1, 'pico', 1714521601000, 'triggered', 'Alarm triggered at 41.0 cm']],
+}
+
+
+def test_resent_batch_is_deduplicated(client):
+    first = post(client, BATCH)
+    assert first.status_code == 200
+    assert first.json['accepted'] == {'readings': 2, 'events': 1}
+
+    again = post(client, BATCH)
+    assert again.status_code == 200
+    assert again.json['received'] == {'readings': 2, 'events': 1}
+    assert again.json['accepted'] == {'readings': 0, 'events': 0}
+    assert stored() == (2, 1)
+
+
+def test_overlapping_batch_only_adds_new_rows(client):
+    post(client, BATCH)
+    overlap = dict(BATCH, readings=[BATCH['readings'][1], [3, 'pico', 1714521602000, 40.0]], events=[])
+    assert post(client, overlap).json['accepted'] == {'readings': 1, 'events': 0}
+    # The same seq from another site or device is a different row
+    assert post(client, dict(BATCH, site='shed')).json['accepted'] == {'readings': 2, 'events': 1}
+    other_device = dict(BATCH, readings=[[1, 'pico-2', 1714521600000, 12.0]], events=[])
+    assert post(client, other_device).json['accepted'] == {'readings': 1, 'events': 0}
+    assert stored() == (6, 2)
+
+
+@pytest.mark.parametrize('body, compress', [
+    (b'{"site": "garage", "readings": [', True),  # truncated JSON
+    (b'not gzip at all', False),
+    (json.dumps({'readings': []}).encode(), True),  # no site
+    (json.dumps({'site': 'garage', 'readings': [[1, 'pico', 1714521600000]]}).encode(), True),  # short row
+    (json.dumps({'site': 'garage', 'events': [[1, 'pico', 'yesterday', 'triggered', '']]}).encode(), True),
+])
+def test_malformed_batch_is_rejected(client, body, compress):
+    if not compress:
+        response = client.post('/ingest/batch', data=body, headers={
+            'Authorization': f'Bearer {TOKEN}', 'Content-Encoding': 'gzip'})
+    else:
+        response = post(client, body)
+    assert response.status_code == 400
+    assert response.json['error'].startswith('malformed batch')
+    assert stored() == (0, 0)
+
+
+def test_requires_the_token(client):
+    assert post(client, BATCH, token='wrong').status_code == 403
+    dashboard.app.config['AGGREGATOR_TOKEN'] = ''
+    assert post(client, BATCH).status_code == 404
+    assert stored() == (0, 0)
+
+
+def test_forwarded_batch_round_trip(client):
+    """What the forwarder reads from its tables is what the aggregator stores."""
+    conn = dashboard.open_raw_db()
+    try:
+        start = {stream: conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                 for stream, (table, _) in dashboard.FORWARD_STREAMS.items()}
+        dashboard.save_readings('pico', [(datetime(2024, 5, 1, 0, 0, 0, 250000), 42.25)])
+        batch, end = dashboard.read_forward_batch(conn, start)
+    finally:
+        conn.close()
+    assert end['readings'] == start['readings'] + 1
+
+    response = post(client, {'site': dashboard.app.config['SITE_ID'], **batch})
+    assert response.json['accepted']['readings'] == 1
+    row = db.session.query(dashboard.RemoteReading).one()
+    assert (row.site, row.device, row.value) == ('test-site', 'pico', 42.25)
+    assert row.timestamp == datetime(2024, 5, 1, 0, 0, 0, 250000)
+    assert post(client, {'site': dashboard.app.config['SITE_ID'], **batch}).json['accepted']['readings'] == 0
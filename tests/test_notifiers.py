@@ -0,0 +1,103 @@
+"""Notifier fan-out: every channel queues, sends and backs off on its own."""
+import threading
+import time
+
+import pytest
+
+from conftest import dashboard
+
+db = dashboard.db
+NotificationOutbox = dashboard.NotificationOutbox
+
+
+@pytest.fixture
+def channels(outbox):
+    """Register test channels: 'ok' records, 'broken' always fails, 'slow' waits for `release`."""
+    delivered = {'ok': [], 'slow': []}
+    release = threading.Event()
+
+    @dashboard.notifier('test-ok', timeout=1)
+    def send_ok(message, timeout):
+        delivered['ok'].append(message)
+
+    @dashboard.notifier('test-broken', timeout=1)
+    def send_broken(message, timeout):
+        raise ConnectionRefusedError('connection refused')
+
+    @dashboard.notifier('test-slow', timeout=5)
+    def send_slow(message, timeout):
+        release.wait(timeout)
+        delivered['slow'].append(message)
+
+    @dashboard.notifier('test-triggers', timeout=1, categories=('trigger',))
+    def send_triggers(message, timeout):
+        pass
+
+    yield delivered, release
+    release.set()
+    wait_until(lambda: not dashboard.outbox_busy)
+    for name in ('test-ok', 'test-broken', 'test-slow', 'test-triggers'):
+        dashboard.NOTIFIERS.pop(name)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+
+def statuses():
+    db.session.expire_all()
+    return {row.channel: row.status for row in NotificationOutbox.query.all()}
+
+
+def test_one_row_per_channel_taking_the_category(channels):
+    dashboard.app.config['NOTIFY_CHANNELS'] = 'test-ok, test-triggers, no-such-channel'
+    dashboard.enqueue_notification('trigger', 'Alarm triggered at 12.0 cm')
+    dashboard.enqueue_notification('online', 'Pico is online')
+    db.session.commit()
+
+    rows = NotificationOutbox.query.order_by(NotificationOutbox.id).all()
+    assert [(row.channel, row.category) for row in rows] == [
+        ('test-ok', 'trigger'), ('test-triggers', 'trigger'), ('test-ok', 'online')]
+
+
+def test_failing_channel_does_not_hold_back_others(channels):
+    delivered, _ = channels
+    dashboard.app.config['NOTIFY_CHANNELS'] = 'test-broken,test-ok'
+    dashboard.enqueue_notification('trigger', 'Alarm triggered at 12.0 cm')
+    db.session.commit()
+
+    assert dashboard.drain_channel('test-broken') == 0
+    assert dashboard.drain_channel('test-ok') == 1
+
+    assert delivered['ok'] == ['Alarm triggered at 12.0 cm']
+    assert statuses() == {'test-broken': 'pending', 'test-ok': 'sent'}
+    broken = NotificationOutbox.query.filter_by(channel='test-broken').one()
+    assert (broken.attempts, broken.last_error) == (1, 'connection refused')
+
+    depth = dashboard.outbox_depth()['channels']
+    assert (depth['test-ok']['sent'], depth['test-ok']['failed_attempts'], depth['test-ok']['pending']) == (1, 0, 0)
+    assert (depth['test-broken']['sent'], depth['test-broken']['failed_attempts'], depth['test-broken']['pending']) == (0, 1, 1)
+    assert depth['test-ok']['latency_ms'] is not None
+    assert depth['test-broken']['latency_ms'] is None
+
+
+def test_slow_channel_does_not_delay_others(channels):
+    delivered, release = channels
+    dashboard.app.config['NOTIFY_CHANNELS'] = 'test-slow,test-ok'
+    dashboard.enqueue_notification('trigger', 'Alarm triggered at 12.0 cm')
+    db.session.commit()
+
+    dashboard.drain_outbox()
+    wait_until(lambda: statuses()['test-ok'] == 'sent')
+    assert delivered['slow'] == []
+    assert 'test-slow' in dashboard.outbox_busy
+
+    # A second pass while the slow channel is still sending does not start another drain for it
+    dashboard.drain_outbox()
+    release.set()
+    wait_until(lambda: statuses()['test-slow'] == 'sent')
+    wait_until(lambda: not dashboard.outbox_busy)
+    assert delivered == {'ok': ['Alarm triggered at 12.0 cm'], 'slow': ['Alarm triggered at 12.0 cm']}
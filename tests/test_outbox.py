@@ -0,0 +1,121 @@
+"""Notification outbox: delivery through a stand-in Pushover, retry with backoff, batching a backlog."""
+import urllib.parse
+from datetime import datetime, timedelta
+
+from conftest import dashboard
+
+db = dashboard.db
+NotificationOutbox = dashboard.NotificationOutbox
+
+
+def queue(message, category='trigger'):
+    rows = dashboard.enqueue_notification(category, message)
+    db.session.commit()
+    return rows
+
+
+def rows_by_id():
+    db.session.expire_all()
+    return NotificationOutbox.query.order_by(NotificationOutbox.id).all()
+
+
+def make_due():
+    """Skip the backoff wait of every pending row."""
+    NotificationOutbox.query.filter_by(status='pending').update({'next_attempt_at': datetime.utcnow()})
+    db.session.commit()
+
+
+def use_stand_in(stand_in):
+    dashboard.app.config['NOTIFY_CHANNELS'] = 'pushover'
+    dashboard.app.config['PUSHOVER_URL'] = f"{stand_in.url}/1/messages.json"
+
+
+def test_round_trip_through_stand_in(outbox, stand_in):
+    use_stand_in(stand_in)
+    queue('Alarm triggered at 12.0 cm')
+
+    assert dashboard.drain_channel('pushover') == 1
+
+    path, headers, body = stand_in.requests[0]
+    assert path == '/1/messages.json'
+    form = urllib.parse.parse_qs(body.decode())
+    assert form['message'] == ['Alarm triggered at 12.0 cm']
+    assert form['token'] == [dashboard.app.config['PUSHOVER_TOKEN']]
+    [row] = rows_by_id()
+    assert (row.status, row.attempts) == ('sent', 1)
+    assert row.sent_at is not None
+
+
+def test_outage_backs_off_then_sends_backlog_as_one_message(outbox, stand_in):
+    use_stand_in(stand_in)
+    stand_in.up = False
+    queue('Alarm triggered at 30.0 cm')
+
+    started = datetime.utcnow()
+    assert dashboard.drain_channel('pushover') == 0
+    [row] = rows_by_id()
+    assert (row.status, row.attempts, row.last_error) == ('pending', 1, 'HTTP 503')
+    wait = row.next_attempt_at - started
+    assert timedelta(seconds=dashboard.OUTBOX_BACKOFF_BASE) <= wait < timedelta(seconds=dashboard.OUTBOX_BACKOFF_BASE + 2)
+
+    # Not due yet: nothing is attempted
+    stand_in.up = True
+    assert dashboard.drain_channel('pushover') == 0
+    assert stand_in.requests == []
+
+    # The second failure doubles the wait
+    stand_in.up = False
+    make_due()
+    started = datetime.utcnow()
+    dashboard.drain_channel('pushover')
+    [row] = rows_by_id()
+    assert row.attempts == 2
+    assert row.next_attempt_at - started >= timedelta(seconds=2 * dashboard.OUTBOX_BACKOFF_BASE)
+
+    # Back up: the backlog goes out in order as one combined message
+    stand_in.up = True
+    queue('Pico is offline', category='offline')
+    make_due()
+    assert dashboard.drain_channel('pushover') == 2
+    assert len(stand_in.requests) == 1
+    message = urllib.parse.parse_qs(stand_in.requests[0][2].decode())['message'][0]
+    assert message.startswith('📬 2 notifications while offline:')
+    assert message.index('Alarm triggered at 30.0 cm') < message.index('Pico is offline')
+    assert [row.status for row in rows_by_id()] == ['sent', 'sent']
+
+
+def test_backoff_is_capped(outbox, stand_in):
+    use_stand_in(stand_in)
+    stand_in.up = False
+    [row] = queue('Alarm triggered at 40.0 cm')
+    row.attempts = 20
+    db.session.commit()
+
+    started = datetime.utcnow()
+    dashboard.drain_channel('pushover')
+    [row] = rows_by_id()
+    wait = row.next_attempt_at - started
+    assert timedelta(seconds=dashboard.OUTBOX_BACKOFF_MAX) <= wait < timedelta(seconds=dashboard.OUTBOX_BACKOFF_MAX + 2)
+
+
+def test_rejected_message_is_not_retried(outbox, stand_in):
+    use_stand_in(stand_in)
+    stand_in.status = 400
+    queue('Alarm triggered at 50.0 cm')
+
+    dashboard.drain_channel('pushover')
+    [row] = rows_by_id()
+    assert (row.status, row.last_error) == ('failed', 'HTTP 400')
+    assert dashboard.drain_channel('pushover') == 0
+    assert len(stand_in.requests) == 1
+
+
+def test_expired_rows_are_dropped(outbox, stand_in):
+    use_stand_in(stand_in)
+    [row] = queue('Alarm triggered at 60.0 cm')
+    row.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    assert dashboard.drain_channel('pushover') == 0
+    assert [row.status for row in rows_by_id()] == ['expired']
+    assert stand_in.requests == []